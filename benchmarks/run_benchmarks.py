@@ -0,0 +1,200 @@
+"""
+    Benchmark swiftwatcher end-to-end and per-stage throughput using
+    synthetic clips with known ground truth. (See synthetic.py.)
+
+    Every combination of resolution, swarm density and file format is
+    generated, then processed in a fresh process so that peak memory
+    is measured independently for each configuration. Run from the
+    repository root:
+
+        python -m benchmarks.run_benchmarks --output bench_results
+
+    Exits with a non-zero status if any configuration fails, or if the
+    baseline pipeline (i.e. without --pipeline-args) doesn't count the
+    known number of swifts in every clip.
+"""
+
+from benchmarks import synthetic
+
+import swiftwatcher.ui as ui
+import swiftwatcher.io_video as vio
+import swiftwatcher.io_data as dio
+import swiftwatcher.profiling as prof
+import swiftwatcher.event_classification as ec
+from swiftwatcher.processing import swift_counting_algorithm
+
+import argparse
+import multiprocessing
+import tempfile
+import queue
+import time
+import sys
+from itertools import product
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+def main(args):
+    configs = [{"width": width, "height": height, "n_swifts": n_swifts,
+                "format": fmt, "n_frames": args.frames, "seed": args.seed}
+               for (width, height), n_swifts, fmt
+               in product(args.resolutions, args.swifts, args.formats)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = Path(args.workdir) if args.workdir else Path(tmp_dir)
+        Path.mkdir(work_dir, parents=True, exist_ok=True)
+
+        summaries, stage_rows, failed = [], [], False
+        for config in configs:
+            print("[*] Benchmarking {width}x{height}, {n_swifts} swifts, "
+                  "{format}.".format(**config))
+            try:
+                summary, stages = run_in_subprocess(config, work_dir,
+                                                    args.pipeline_args)
+            except RuntimeError as e:
+                print("[!] {}".format(e))
+                failed = True
+                continue
+
+            summaries.append(summary)
+            stage_rows.extend(dict(stage, **config) for stage in stages)
+            print("[-]     {fps:.1f} frames/sec, {peak_rss_mb} MB peak RSS, "
+                  "counted {counted}/{groundtruth}.".format(**summary))
+
+            # Accuracy is only known for the baseline pipeline
+            if not args.pipeline_args and summary["abs_error"] != 0:
+                print("[!] Baseline count doesn't match the ground truth.")
+                failed = True
+
+    if summaries:
+        dio.dataframe_to_csv(pd.DataFrame(summaries).set_index("name"),
+                             args.output / "benchmark_summary.csv")
+        dio.dataframe_to_csv(pd.DataFrame(stage_rows).set_index("stage"),
+                             args.output / "benchmark_stages.csv")
+
+    sys.exit(1 if failed else 0)
+
+
+def run_in_subprocess(config, work_dir, pipeline_args):
+    """Run a single configuration in a fresh process, returning its
+    summary and per-stage results."""
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_config,
+                              args=(config, work_dir, pipeline_args, results))
+    process.start()
+
+    while True:
+        try:
+            summary, stages = results.get(timeout=1)
+            break
+        except queue.Empty:
+            # Otherwise, a crashed benchmark would leave us waiting forever
+            if not process.is_alive():
+                try:
+                    summary, stages = results.get(timeout=1)
+                    break
+                except queue.Empty:
+                    raise RuntimeError("Benchmark process exited with code "
+                                       "{} before reporting results."
+                                       .format(process.exitcode))
+    process.join()
+
+    return summary, stages
+
+
+def run_config(config, work_dir, pipeline_args, results):
+    """Generate a clip, then measure throughput, memory and accuracy
+    of the swift counting algorithm on it."""
+
+    name = "synthetic_{width}x{height}_{n_swifts}swifts".format(**config)
+    suffix = ".h5" if config["format"] == "hdf5" else ".mp4"
+    filepath = work_dir / (name + suffix)
+    corners, groundtruth = synthetic.generate_clip(
+        filepath, config["width"], config["height"], config["n_frames"],
+        n_swifts=config["n_swifts"], seed=config["seed"])
+
+    args = ui.parse_args(["--filepaths", str(filepath),
+                          "--checkpoint-interval", "0"] + pipeline_args)
+    if filepath.suffix == ".h5":
+        reader = vio.HDF5Reader(filepath, args.start, args.end)
+    else:
+        reader = vio.VideoReader(filepath, args.end, args.start)
+
+    prof.profiler.enabled = True
+    prof.profiler.reset()
+    start = time.perf_counter()
+    events = swift_counting_algorithm(reader, corners, args)
+    counted = count_predicted(events)
+    elapsed = time.perf_counter() - start
+
+    summary = {
+        "name": name + suffix,
+        "frames": reader.total_frames,
+        "seconds": elapsed,
+        "fps": reader.total_frames / elapsed,
+        "peak_rss_mb": get_peak_rss_mb(),
+        "groundtruth": groundtruth,
+        "counted": counted,
+        "abs_error": abs(counted - groundtruth),
+    }
+    results.put((summary, prof.profiler.report()))
+
+
+def count_predicted(events):
+    """Classify events in the same way as main(), returning the count."""
+
+    if not events:
+        return 0
+
+    df_features = ec.generate_angle_features_from_arrays(
+        ec.convert_events_to_arrays(events))
+    df_labels = ec.classify_features(df_features)
+
+    return int(np.sum(df_labels["label"] > 0))
+
+
+def get_peak_rss_mb():
+    """Peak resident set size of the current process, if available."""
+
+    if resource is None:
+        return None
+
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default="bench_results")
+    parser.add_argument("--workdir", default=None)
+    parser.add_argument("--resolutions", nargs="+",
+                        default=["1280x720", "1920x1080"])
+    parser.add_argument("--swifts", type=int, nargs="+", default=[5, 25])
+    parser.add_argument("--formats", nargs="+", default=["video", "hdf5"],
+                        choices=["video", "hdf5"])
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--pipeline-args", default="",
+                        help="Extra swiftwatcher arguments, e.g. "
+                             "'--classify --batch-size 64'")
+    args = parser.parse_args()
+
+    args.output = Path(args.output)
+    args.resolutions = [tuple(int(v) for v in resolution.split("x"))
+                        for resolution in args.resolutions]
+    args.pipeline_args = args.pipeline_args.split()
+
+    return args
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,99 @@
+"""
+    Measure how long swiftwatcher takes to start up (i.e. import its
+    modules and parse arguments) and check that it stays within budget.
+    Modules which are only needed by optional features (e.g. torch for
+    '--classify', tkinter for file selection dialogs) must not be
+    imported during a normal headless run. Run from the repository root:
+
+        python -m benchmarks.startup --budget 1.5
+
+    Exits with a non-zero status if the budget is exceeded, so that it
+    can be used to catch startup regressions.
+"""
+
+import argparse
+import subprocess
+import json
+import sys
+
+# Modules which should only be imported by the features that need them
+DEFERRED_MODULES = ["torch", "torchvision", "tkinter", "h5py", "pyarrow"]
+
+STARTUP_SCRIPT = """
+import time, sys, json
+start = time.perf_counter()
+import swiftwatcher.__main__ as main
+main.ui.parse_args(["--filepaths", "video.mp4"])
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed,
+                  "loaded": [m for m in %r if m in sys.modules]}))
+"""
+
+
+def main(args):
+    results = [measure_startup() for _ in range(args.repeats)]
+    best = min(result["seconds"] for result in results)
+    loaded = sorted(set(m for result in results for m in result["loaded"]))
+
+    print("[*] Startup time: {:.3f}s (best of {}), budget {:.3f}s."
+          .format(best, args.repeats, args.budget))
+    if args.importtime:
+        print_slowest_imports(args.importtime)
+
+    failed = False
+    if best > args.budget:
+        print("[!] Startup time exceeds budget.")
+        failed = True
+    if loaded:
+        print("[!] Deferred modules were imported at startup: {}"
+              .format(", ".join(loaded)))
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+def measure_startup():
+    """Time imports and argument parsing in a fresh interpreter, which
+    is what each run of swiftwatcher in a batch job pays for."""
+
+    output = subprocess.run([sys.executable, "-c",
+                             STARTUP_SCRIPT % DEFERRED_MODULES],
+                            stdout=subprocess.PIPE, check=True)
+
+    return json.loads(output.stdout.decode().strip().splitlines()[-1])
+
+
+def print_slowest_imports(n):
+    """Print the modules which take the longest to import (including
+    the modules they import), using Python's -X importtime option."""
+
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                             "import swiftwatcher.__main__"],
+                            stderr=subprocess.PIPE, check=True)
+
+    timings = []
+    for line in output.stderr.decode().splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            timings.append((int(cumulative), module.strip()))
+
+    print("[-]     Slowest imports (cumulative):")
+    for microseconds, module in sorted(timings, reverse=True)[:n]:
+        print("[-]     {:>8.3f}s  {}".format(microseconds / 1e6, module))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget", type=float, default=1.5,
+                        help="Maximum startup time in seconds")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--importtime", type=int, default=15,
+                        help="Number of slowest imports to print (0: none)")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
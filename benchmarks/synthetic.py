@@ -0,0 +1,163 @@
+"""
+    Procedurally generates synthetic roost videos with known ground
+    truth, for benchmarking swiftwatcher without real footage.
+
+    Each clip shows a sky gradient and a brick chimney. Dark blobs
+    ("swifts") fly down into the chimney, while other blobs ("flybys")
+    cross the frame above the chimney without entering it. Clips can be
+    written as video files (read by VideoReader) or as HDF5 files of
+    encoded frames (read by HDF5Reader).
+"""
+
+from pathlib import Path
+import json
+
+import numpy as np
+import cv2
+import h5py
+
+# Colours are BGR. The chimney must have a much lower blue channel than
+# the sky, as the chimney's ROI is found by thresholding that channel.
+SKY_TOP = np.array([235, 205, 170], dtype=np.float32)
+SKY_BOTTOM = np.array([250, 230, 210], dtype=np.float32)
+CHIMNEY = (45, 60, 140)
+BIRD = (40, 40, 40)
+
+
+def generate_clip(filepath, width=1280, height=720, n_frames=300, fps=30,
+                  n_swifts=10, n_flybys=5, noise=2.0, seed=0):
+    """Generate a synthetic clip and write it to filepath. The format is
+    chosen by file extension ('.h5'/'.hdf5' for HDF5, otherwise a video
+    file). Chimney corners are also written to the attributes.json file
+    that swiftwatcher looks for. Returns the corners and the number of
+    swifts that enter the chimney (i.e. the ground truth count)."""
+
+    filepath = Path(filepath)
+    rng = np.random.RandomState(seed)
+
+    # Chimney is centered, with its top edge just over halfway down
+    chimney_width = int(0.2 * width)
+    left = (width - chimney_width) // 2
+    right = left + chimney_width
+    top = int(0.55 * height)
+    corners = [(left, top), (right, top)]
+
+    background = draw_background(width, height, left, right, top)
+    paths = ([swift_path(rng, left, right, top, chimney_width, n_frames)
+              for _ in range(n_swifts)] +
+             [flyby_path(rng, width, top, chimney_width, n_frames)
+              for _ in range(n_flybys)])
+    radius = max(2, int(round(width / 400)))
+
+    frames = (draw_frame(background, paths, i, radius, noise, rng)
+              for i in range(n_frames))
+
+    if filepath.suffix in [".h5", ".hdf5"]:
+        write_hdf5(filepath, frames, n_frames, fps)
+    else:
+        write_video(filepath, frames, width, height, fps)
+
+    write_attributes(filepath, corners)
+
+    return corners, n_swifts
+
+
+def draw_background(width, height, left, right, top):
+    """Draw a vertical sky gradient with a chimney stack."""
+
+    weights = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+    sky = (1 - weights) * SKY_TOP + weights * SKY_BOTTOM
+    background = np.repeat(sky, width, axis=1).astype(np.uint8)
+    cv2.rectangle(background, (left, top), (right, height), CHIMNEY, -1)
+
+    return background
+
+
+def swift_path(rng, left, right, top, chimney_width, n_frames):
+    """Create a path which descends towards the chimney, ending (and so
+    disappearing) within the ROI just above the chimney's top edge,
+    which is where swiftwatcher detects that a swift has entered."""
+
+    length = rng.randint(20, 40)
+    start = rng.randint(0, max(1, n_frames - length - 25))
+    x_end = rng.uniform(left + 0.2 * chimney_width,
+                        right - 0.2 * chimney_width)
+    y_end = top - int(0.05 * chimney_width)
+    drift = rng.uniform(-0.5, 0.5)
+
+    steps = np.arange(length)[::-1]
+    xs = x_end - drift * steps
+    ys = y_end - rng.uniform(0.5, 0.7) * chimney_width * steps / length
+
+    return {"start": start, "xs": xs, "ys": ys}
+
+
+def flyby_path(rng, width, top, chimney_width, n_frames):
+    """Create a path which crosses the entire frame horizontally above
+    the chimney, disappearing at the edge of the frame."""
+
+    speed = rng.uniform(8, 15)
+    length = int(width / speed)
+    start = rng.randint(0, max(1, n_frames - length))
+    y = top - rng.uniform(0.3, 0.45) * chimney_width
+    direction = rng.choice([-1, 1])
+
+    xs = np.arange(length) * speed
+    if direction < 0:
+        xs = width - xs
+
+    return {"start": start, "xs": xs, "ys": np.full(length, y)}
+
+
+def draw_frame(background, paths, frame_number, radius, noise, rng):
+    """Draw every bird visible in a frame on top of the background."""
+
+    frame = background.copy()
+
+    for path in paths:
+        step = frame_number - path["start"]
+        if 0 <= step < len(path["xs"]):
+            center = (int(path["xs"][step]), int(path["ys"][step]))
+            cv2.ellipse(frame, center, (radius * 2, radius), 0, 0, 360,
+                        BIRD, -1)
+
+    if noise > 0:
+        frame = np.clip(frame + rng.normal(0, noise, frame.shape),
+                        0, 255).astype(np.uint8)
+
+    return frame
+
+
+def write_video(filepath, frames, width, height, fps):
+    writer = cv2.VideoWriter(str(filepath), cv2.VideoWriter_fourcc(*"mp4v"),
+                             fps, (width, height))
+    if not writer.isOpened():
+        raise OSError("Unable to write video '{}'.".format(filepath))
+    for frame in frames:
+        writer.write(frame)
+    writer.release()
+
+
+def write_hdf5(filepath, frames, n_frames, fps):
+    """Write frames in the format expected by HDF5Reader: a dataset
+    of PNG-encoded frames named "VideoFrames", with capture attributes."""
+
+    with h5py.File(str(filepath), "w") as h5_file:
+        dset = h5_file.create_dataset("VideoFrames", (n_frames,),
+                                      dtype=h5py.special_dtype(vlen=np.uint8))
+        for i, frame in enumerate(frames):
+            dset[i] = cv2.imencode(".png", frame)[1].ravel()
+
+        dset.attrs["CAP_PROP_FPS"] = fps
+        dset.attrs["CAP_PROP_FRAME_COUNT"] = n_frames
+
+
+def write_attributes(filepath, corners):
+    """Write corners to the same location as ui.save_corners_to_file."""
+
+    base_dir = filepath.parent / filepath.stem
+    if not base_dir.exists():
+        Path.mkdir(base_dir, parents=True)
+
+    with open(str(base_dir / "attributes.json"), "w") as fp:
+        json.dump({"corners": corners}, fp)
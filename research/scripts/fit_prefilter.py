@@ -0,0 +1,70 @@
+"""
+    Fit segment prefilter thresholds from an exported segment dataset.
+
+    Segments exported with '--export' are written alongside a
+    'segments.csv' file containing their shape features. Once the
+    exported images have been sorted into one folder per class (the
+    same layout used to train the CNN, where the second folder in
+    sorted order contains chimney swifts), this script learns the
+    thresholds used by swiftwatcher's '--prefilter' option.
+"""
+
+import swiftwatcher.segment_classification as sc
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+def main(metadata_filepaths, dataset_dir, output_filepath, purity):
+    df_features = pd.concat([pd.read_csv(str(filepath))
+                             for filepath in metadata_filepaths])
+    df_features = df_features.drop_duplicates("filename").set_index("filename")
+
+    # Class label is given by the position of each folder in sorted order
+    filenames, labels = [], []
+    class_dirs = sorted(path for path in dataset_dir.iterdir()
+                        if path.is_dir())
+    for label, class_dir in enumerate(class_dirs):
+        for image_path in class_dir.glob("*.png"):
+            filenames.append(image_path.name)
+            labels.append(label)
+
+    df_labels = pd.DataFrame({"label": labels}, index=filenames)
+    df_dataset = df_features.drop(columns="label").join(df_labels,
+                                                        how="inner")
+    print("[*] Fitting prefilter to {} labeled segments."
+          .format(len(df_dataset)))
+
+    features = df_dataset[["area", "aspect", "intensity"]].values
+    prefilter = sc.fit_prefilter(features, df_dataset["label"].values, purity)
+    prefilter.save(output_filepath)
+
+    decisions = prefilter.decide(features)
+    print("[-]     Accepted: {:.1%}, rejected: {:.1%}, ambiguous: {:.1%}"
+          .format(np.mean(decisions == 1), np.mean(decisions == 0),
+                  np.mean(decisions == sc.AMBIGUOUS)))
+    print("[-]     Prefilter thresholds saved to {}.".format(output_filepath))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dataset_dir")
+    parser.add_argument("metadata_filepaths", nargs="+")
+    parser.add_argument("--output", default=str(sc.PREFILTER_PATH))
+    parser.add_argument("--purity", type=float, default=0.99)
+    args = parser.parse_args()
+
+    args.dataset_dir = Path(args.dataset_dir)
+    args.metadata_filepaths = [Path(f) for f in args.metadata_filepaths]
+    args.output = Path(args.output)
+
+    return args
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    main(arguments.metadata_filepaths, arguments.dataset_dir,
+         arguments.output, arguments.purity)
@@ -0,0 +1,118 @@
+"""
+    Sweep tracking and event classification parameters over videos
+    that have both cached segmentation output (from running swiftwatcher
+    with '--cache-segments') and ground truth counts.
+
+    Videos are taken from research/video_list.csv. For each video with
+    a ground truth file, '<videos_dir>/<video stem>/df_groundtruth.csv'
+    is used, along with the segment cache matching the video, its
+    corners (from '<videos_dir>/<video stem>/attributes.json') and the
+    queue size. (Caches created with other parameters are ignored.)
+"""
+
+import swiftwatcher.io_data as dio
+import swiftwatcher.io_cache as ioc
+import swiftwatcher.io_video as vio
+import swiftwatcher.ui as ui
+import swiftwatcher.parameter_sweep as sweep
+
+import argparse
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+
+def main(args):
+    df_videos = pd.read_csv(str(args.video_list), sep="\t")
+    df_videos = df_videos[df_videos["df_groundtruth.csv"] == "Yes"]
+
+    videos = []
+    for video_name in df_videos["Video name"]:
+        video_dir = args.videos_dir / Path(video_name).stem
+        cache_path = find_segment_cache(args.videos_dir / video_name,
+                                        args.queue_size)
+        if cache_path is None:
+            print("[!] No matching segment cache found for '{}', skipping."
+                  .format(video_name))
+            continue
+
+        df_groundtruth = dio.dataframe_from_csv(video_dir /
+                                                "df_groundtruth.csv")
+        if args.gt_column:
+            df_groundtruth = df_groundtruth[[args.gt_column]]
+        videos.append((video_name, cache_path, df_groundtruth))
+
+    if not videos:
+        sys.stderr.write("[!] Error: No videos with both segment caches and "
+                         "ground truth were found.\n")
+        sys.exit()
+
+    tracking_grid = {
+        "distance_offset": args.distance_offsets,
+        "angle_offset": args.angle_offsets,
+        "nonmatch_cost": args.nonmatch_costs,
+    }
+    print("[*] Sweeping {} configurations over {} videos.".format(
+        len(args.windows) * len(args.distance_offsets) *
+        len(args.angle_offsets) * len(args.nonmatch_costs), len(videos)))
+
+    df_summary, df_results = sweep.run_sweep(videos, tracking_grid,
+                                             args.windows, args.processes)
+
+    dio.dataframe_to_csv(df_summary, args.output / "sweep_summary.csv")
+    dio.dataframe_to_csv(df_results, args.output / "sweep_per_video.csv")
+    print("[-]     Best configurations:")
+    print(df_summary.head(10).to_string(index=False))
+
+
+def find_segment_cache(video_path, queue_size):
+    """Return the path of the segment cache created from an entire
+    video with the given queue size, or None if there isn't one."""
+
+    video_dir = video_path.parent / video_path.stem
+    if not (video_path.is_file() and
+            (video_dir / "attributes.json").is_file()):
+        return None
+
+    corners = ui.get_corners_from_file(video_dir / "attributes.json")
+    reader = vio.VideoReader(video_path, -1)
+    key = ioc.segment_cache_key(video_path, corners, reader.start_frame,
+                                reader.end_frame, queue_size)
+    cache_path = ioc.get_segment_cache_path(video_dir, key)
+
+    return cache_path if cache_path.is_file() else None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("videos_dir")
+    parser.add_argument("--video-list", default=str(Path(__file__).parents[1]
+                                                    / "video_list.csv"))
+    parser.add_argument("--output", default="sweep_results")
+    parser.add_argument("--gt-column", default=None)
+    parser.add_argument("--queue-size", default="21",
+                        help="Queue size the caches were created with "
+                             "('adaptive' if --adaptive-queue was used)")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--distance-offsets", type=float, nargs="+",
+                        default=[20, 25, 30])
+    parser.add_argument("--angle-offsets", type=float, nargs="+",
+                        default=[60, 90, 120])
+    parser.add_argument("--nonmatch-costs", type=float, nargs="+",
+                        default=[0.5, 1, 2])
+    parser.add_argument("--windows", type=float, nargs="+",
+                        default=[20, 30, 40])
+    args = parser.parse_args()
+
+    args.videos_dir = Path(args.videos_dir)
+    args.video_list = Path(args.video_list)
+    args.output = Path(args.output)
+    if args.queue_size != "adaptive":
+        args.queue_size = int(args.queue_size)
+
+    return args
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,96 @@
+"""
+    Create the int8 quantized segment classifier used by swiftwatcher's
+    '--quantized' option.
+
+    Exported segment images (see '--export') are split into a
+    calibration set, used to determine activation ranges, and a
+    held-out set, used to check that the quantized model still agrees
+    with the float model. If the images are sorted into one folder per
+    class (as used to train the CNN), accuracy is reported as well.
+"""
+
+import swiftwatcher.segment_classification as sc
+
+import argparse
+import sys
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+
+def main(dataset_dir, model_path, holdout_fraction, min_agreement):
+    images, labels = load_segment_images(dataset_dir)
+    if len(images) == 0:
+        sys.stderr.write("[!] Error: No segment images found in {}.\n"
+                         .format(dataset_dir))
+        sys.exit()
+
+    # Split images into calibration and held-out sets
+    order = np.random.RandomState(0).permutation(len(images))
+    n_holdout = max(1, int(holdout_fraction * len(images)))
+    holdout, calibration = order[:n_holdout], order[n_holdout:]
+
+    print("[*] Calibrating quantized model using {} segments."
+          .format(len(calibration)))
+    float_model, quantized_model = \
+        sc.quantize_model(model_path, [images[i] for i in calibration])
+
+    print("[*] Evaluating quantized model using {} held-out segments."
+          .format(len(holdout)))
+    holdout_labels = labels[holdout] if labels is not None else None
+    results = sc.evaluate_quantized_model(float_model, quantized_model,
+                                          [images[i] for i in holdout],
+                                          holdout_labels)
+    for name, value in results.items():
+        print("[-]     {}: {:.2%}".format(name, value))
+
+    if results["agreement"] < min_agreement:
+        sys.stderr.write("[!] Error: Quantized model agrees with float model "
+                         "on fewer than {:.2%} of segments. Model not saved.\n"
+                         .format(min_agreement))
+        sys.exit(1)
+
+    sc.save_quantized_model(quantized_model, model_path)
+    print("[-]     Quantized model saved to {}."
+          .format(sc.get_artifact_path(model_path, quantized=True)))
+
+
+def load_segment_images(dataset_dir):
+    """Load segment images from a directory. If the directory contains
+    one subdirectory per class, labels are returned too."""
+
+    class_dirs = sorted(path for path in dataset_dir.iterdir()
+                        if path.is_dir())
+
+    if class_dirs:
+        images, labels = [], []
+        for label, class_dir in enumerate(class_dirs):
+            for image_path in sorted(class_dir.glob("*.png")):
+                images.append(cv2.imread(str(image_path)))
+                labels.append(label)
+        return images, np.array(labels)
+    else:
+        images = [cv2.imread(str(image_path))
+                  for image_path in sorted(dataset_dir.glob("*.png"))]
+        return images, None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dataset_dir")
+    parser.add_argument("--model", default=str(sc.MODEL_PATH))
+    parser.add_argument("--holdout", type=float, default=0.2)
+    parser.add_argument("--min-agreement", type=float, default=0.99)
+    args = parser.parse_args()
+
+    args.dataset_dir = Path(args.dataset_dir)
+    args.model = Path(args.model)
+
+    return args
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    main(arguments.dataset_dir, arguments.model,
+         arguments.holdout, arguments.min_agreement)
@@ -28,7 +28,8 @@ setup(
     packages=["swiftwatcher"],
     include_package_data=True,
     install_requires=[
-        "numpy", "opencv-python", "pandas", "scikit-image", "scipy"
+        "numpy", "opencv-python", "pandas", "scikit-image", "scipy",
+        "threadpoolctl"
     ],
     entry_points={"console_scripts":
                   ["swiftwatcher = swiftwatcher.__main__:main"]},
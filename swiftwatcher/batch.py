@@ -0,0 +1,244 @@
+"""
+    Contains functionality for processing many videos without user
+    interaction, either from a manifest or from a shared work queue,
+    optionally in several processes at once. Functions which run in
+    worker processes are kept here (rather than in __main__.py) so that
+    they can be found by processes started with the "spawn" method.
+"""
+
+import swiftwatcher.ui as ui
+import swiftwatcher.io_data as dio
+import swiftwatcher.event_classification as ec
+import swiftwatcher.processing as proc
+import swiftwatcher.work_queue as wq
+import swiftwatcher.thread_budget as tb
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from pathlib import Path
+import time
+import csv
+
+
+def process_manifest(args):
+    """Process every job listed in a manifest without any user
+    interaction, running up to args.jobs videos concurrently. A failed
+    job doesn't stop the batch; the outcome of every job is written to
+    '<manifest name>_results.csv' next to the manifest."""
+
+    jobs = ui.load_manifest(args.manifest, args)
+    print("[*] Processing {} jobs from manifest '{}' ({} at a time)."
+          .format(len(jobs), args.manifest.name, args.jobs))
+
+    job_args = [(job, args) for job in jobs]
+    if args.jobs > 1:
+        # The parent only coordinates, so the budget goes to the jobs
+        tb.configure(1)
+        with tb.child_environment(tb.get_budget(args)):
+            results = process_jobs_in_pool(job_args, args.jobs)
+    else:
+        results = [process_job(*job) for job in job_args]
+
+    results_path = args.manifest.parent / (args.manifest.stem +
+                                           "_results.csv")
+    with open(str(results_path), "w", newline="") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=["filepath", "status",
+                                                      "events", "seconds",
+                                                      "error"])
+        writer.writeheader()
+        writer.writerows(results)
+
+    n_failed = sum(result["status"] != "done" for result in results)
+    print("[*] Manifest complete: {} succeeded, {} failed. See {}."
+          .format(len(results) - n_failed, n_failed, results_path.name))
+
+
+def process_jobs_in_pool(job_args, n_processes):
+    """Run process_job for each (job, args) tuple in a pool of worker
+    processes, returning results in the same order. Workers are spawned
+    (not forked) so that each one loads BLAS with its budget.
+
+    If a worker process dies (e.g. killed when out of memory), the pool
+    is broken and every unfinished job fails with it. Those jobs are
+    retried one at a time, so that only the job which caused the worker
+    to die is recorded as failed."""
+
+    results = run_in_pool(job_args, n_processes)
+    broken = [i for i, result in enumerate(results) if result is None]
+    if broken:
+        print("[!] A worker process exited unexpectedly, so {} unfinished "
+              "jobs will be retried one at a time.".format(len(broken)))
+
+    for i in broken:
+        results[i] = run_in_pool([job_args[i]], 1)[0]
+        if results[i] is None:
+            job = job_args[i][0]
+            print("[!] Job '{}' failed, as its worker process exited "
+                  "unexpectedly.".format(Path(job["filepath"]).name))
+            results[i] = {"filepath": str(Path(job["filepath"])),
+                          "status": "failed", "events": None,
+                          "seconds": None,
+                          "error": "BrokenProcessPool: worker process "
+                                   "exited unexpectedly"}
+
+    return results
+
+
+def run_in_pool(job_args, n_processes):
+    """Run process_job for each (job, args) tuple in a new pool, with a
+    result of None for any job which didn't finish as the pool broke."""
+
+    context = multiprocessing.get_context("spawn")
+    results = [None] * len(job_args)
+
+    with ProcessPoolExecutor(n_processes, context) as executor:
+        futures = [executor.submit(process_job, *args) for args in job_args]
+        for i, future in enumerate(futures):
+            try:
+                results[i] = future.result()
+            except BrokenProcessPool:
+                pass
+
+    return results
+
+
+def process_job(job, args):
+    """Process a single manifest (or queued) job, catching any errors so
+    that the rest of the batch can continue."""
+
+    start = time.perf_counter()
+    filepath = Path(job["filepath"])
+    result = {"filepath": str(filepath), "status": "done",
+              "events": None, "error": None}
+
+    try:
+        job_args = ui.apply_job_options(args, job["options"])
+        corners = job["corners"]
+        if corners is not None:
+            corners = [tuple(corner) for corner in corners]
+        result["events"] = proc.process_video(
+            filepath, corners, job_args, job.get("output_subdir"),
+            save_features=job.get("shard") is not None)
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+        print("[!] Job '{}' failed with {}".format(filepath.name,
+                                                   result["error"]))
+
+    result["seconds"] = time.perf_counter() - start
+
+    return result
+
+
+def submit_to_queue(args):
+    """Add jobs (from a manifest, or one per filepath) to a work queue,
+    optionally splitting each video into shards of consecutive frames."""
+
+    if args.manifest is not None:
+        jobs = ui.load_manifest(args.manifest, args)
+    else:
+        jobs = [{"filepath": filepath, "corners": None, "options": {}}
+                for filepath in args.filepaths]
+
+    if args.shard_frames > 0:
+        sharded_jobs = []
+        for job in jobs:
+            job_args = ui.apply_job_options(args, job["options"])
+            reader = proc.open_reader(Path(job["filepath"]), job_args)
+
+            # Overlapping by a queue lets events crossing a boundary be
+            # tracked from before the boundary
+            sharded_jobs.extend(wq.split_into_shards(
+                job, reader.end_frame, args.shard_frames,
+                job_args.queue_size, reader.fps))
+        jobs = sharded_jobs
+
+    queue = wq.WorkQueue(args.queue, args.heartbeat_timeout)
+    queue.submit(jobs)
+    print("[*] Submitted {} jobs to queue '{}'.".format(len(jobs),
+                                                        args.queue))
+
+
+def run_queue_workers(args):
+    """Process jobs from a work queue in args.jobs worker processes."""
+
+    if args.jobs > 1:
+        tb.configure(1)
+        context = multiprocessing.get_context("spawn")
+        workers = [context.Process(target=run_queue_worker, args=(args,))
+                   for _ in range(args.jobs)]
+        with tb.child_environment(tb.get_budget(args)):
+            for worker in workers:
+                worker.start()
+        for worker in workers:
+            worker.join()
+    else:
+        run_queue_worker(args)
+
+    counts = wq.WorkQueue(args.queue).counts()
+    print("[*] Queue complete: {} done, {} failed."
+          .format(counts["done"], counts["failed"]))
+
+
+def run_queue_worker(args):
+    """Claim and process jobs until the queue is empty. While other
+    workers still hold claimed jobs, keep polling, as those jobs are
+    re-queued if their workers die."""
+
+    queue = wq.WorkQueue(args.queue, args.heartbeat_timeout)
+
+    while True:
+        for job_id in queue.requeue_stale():
+            print("[!] Re-queued job '{}' from an unresponsive worker."
+                  .format(job_id))
+
+        job = queue.claim()
+        if job is None:
+            if queue.counts()["claimed"] == 0:
+                break
+            time.sleep(args.heartbeat_timeout / 4)
+            continue
+
+        heartbeat = wq.Heartbeat(queue, job)
+        try:
+            result = process_job(job, args)
+        finally:
+            heartbeat.stop()
+        if not queue.finish(job, result["status"], result):
+            print("[!] Job '{}' was re-queued while being processed, so "
+                  "its result was discarded.".format(job["id"]))
+        elif job.get("shard") is not None and result["status"] == "done":
+            merge_shards(queue, job, args)
+
+
+def merge_shards(queue, job, args):
+    """Once every shard of a video has been processed, classify the
+    events of every shard together (as the angle mode is estimated from
+    all of a video's events), then export results for the entire video
+    to the video's output directory. Only one worker merges each video."""
+
+    shard = job["shard"]
+    shard_jobs = queue.get_shard_jobs(shard["group"])
+    if (len(shard_jobs) < shard["count"] or
+            not queue.claim_merge(shard["group"])):
+        return
+
+    filepath = Path(job["filepath"])
+    output_dir = filepath.parent / filepath.stem
+    job_args = ui.apply_job_options(args, job["options"])
+    df_features = dio.load_shard_features(
+        [(output_dir / shard_job["output_subdir"],
+          shard_job["shard"]["start"], shard_job["shard"]["end"])
+         for shard_job in shard_jobs])
+    if df_features.empty:
+        print("[!] No events detected in any of the {} shards of '{}'."
+              .format(shard["count"], filepath.name))
+        return
+
+    df_labels = ec.classify_features(df_features)
+    total = dio.export_results(output_dir, df_labels, shard["fps"],
+                               shard["video_start"], shard["video_end"],
+                               job_args.full_usec)
+    print("[*] Merged results of {} shards of '{}' ({} swifts)."
+          .format(shard["count"], filepath.name, total))
@@ -7,10 +7,22 @@
 
 from collections import OrderedDict, deque
 
-from pathlib import Path
 import swiftwatcher.image_filtering as img
-import cv2
-import math
+import swiftwatcher.profiling as prof
+
+# Parameters of each segmentation stage used by FrameQueue.segment_queue.
+# (Changing these will invalidate any cached segmentation output.)
+SEGMENTATION_PARAMS = {
+    "bilateral": (7, 15, 1),
+    "thresh": 15,
+    "opening": (3, 3),
+    "connectivity": 4,
+}
+
+# Fewest frames segmented at once. RPCA can't separate foreground from
+# background using only a handful of frames, so a short final batch is
+# merged into the batch before it.
+MIN_QUEUE_SIZE = 5
 
 
 class Segment:
@@ -29,6 +41,19 @@ class Segment:
             if not a.startswith('_'):
                 setattr(self, a, getattr(regionprops, a, None))
 
+    @classmethod
+    def from_attributes(cls, frame_number, timestamp, segment_image,
+                        attributes):
+        """Create a segment from a dictionary of previously stored
+        attributes (e.g. centroid, bbox, area), rather than from a
+        RegionProperties object."""
+
+        segment = cls(None, frame_number, timestamp, segment_image)
+        for a, value in attributes.items():
+            setattr(segment, a, value)
+
+        return segment
+
 
 class Frame:
     """Class for storing a frame from a video, as well as processed
@@ -62,56 +87,6 @@ class Frame:
         self.segments = [Segment(rp, self.frame_number, self.timestamp, seg)
                          for rp, seg in zip(regionprops_list, segment_images)]
 
-    def export_segments(self, min_seg_size, crop_region, export_dir):
-        if not export_dir.exists():
-            Path.mkdir(export_dir, parents=True)
-
-        color_img = self.processed_frames["crop"]
-        for segment in self.segments:
-            name_str = '"{}"_{}_{}_{}.png'.format(self.src_video,
-                                                  self.frame_number,
-                                                  segment.label,
-                                                  len(self.segments))
-            bbox = list(segment.bbox)
-
-            # Bounding box provided by RegionProps: [H1, W1,   H2, W2]
-            # My convention:                       [(W1, H1), (W2, H2)]
-            # TODO: Fix all usages of my old convention in swiftwatcher
-            crop = [crop_region[0][1], crop_region[0][0],
-                    crop_region[1][1], crop_region[1][0]]
-
-            # Export image highlighting area of segment
-            overlay = color_img.copy()
-            output = color_img.copy()
-            alpha = 0.6
-            cv2.rectangle(overlay, (bbox[1], bbox[0]), (bbox[3], bbox[2]),
-                          (0, 0, 255), -1)
-            cv2.addWeighted(overlay, alpha, output, 1 - alpha, 0, output)
-            if not Path.exists(export_dir / "overlay"):
-                Path.mkdir(export_dir / "overlay")
-            cv2.imwrite(str(export_dir / "overlay" / name_str), output)
-
-            # Expand segment bbox to min seg size (keeping centered)
-            dimensions = (bbox[2]-bbox[0], bbox[3]-bbox[1])
-            if dimensions[0] < min_seg_size[0]:
-                diff = min_seg_size[0] - dimensions[0]
-                bbox[0] -= math.floor(diff/2)
-                bbox[2] += math.ceil(diff/2)
-            if dimensions[1] < min_seg_size[1]:
-                diff2 = min_seg_size[1] - dimensions[1]
-                bbox[1] -= math.floor(diff2 / 2)
-                bbox[3] += math.ceil(diff2 / 2)
-
-            # Extract segment image from full frame (not cropped image)
-            bbox_f = [bbox[0]+crop[0], bbox[1]+crop[1],
-                      bbox[2]+crop[0], bbox[3]+crop[1]]
-            color_img_full = self.frame
-            color_seg = color_img_full[bbox_f[0]:bbox_f[2],
-                                       bbox_f[1]:bbox_f[3]]
-
-            # Write segment to file
-            cv2.imwrite(str(export_dir / name_str), color_seg)
-
 
 class FrameQueue(deque):
     """Class which extends Python's collections' deque class, adding
@@ -148,6 +123,11 @@ class FrameQueue(deque):
 
         return popped_frame
 
+    def pop_all_frames(self):
+        """Pop every frame off of queue, returned in frame order."""
+
+        return [self.pop_frame() for _ in range(len(self))]
+
     def store_processed_queue(self, processed_frame_list, process_name):
         for pos, frame in enumerate(processed_frame_list):
             self[pos].processed_frames[process_name] = frame
@@ -172,46 +152,160 @@ class FrameQueue(deque):
         """Apply image filtering methods to preprocess every frame in
         queue, storing every stage individually."""
 
-        cropped_frames = [img.crop_frame(frame, crop_region)
-                          for frame in self.get_queue()]
-        self.store_processed_queue(cropped_frames, "crop")
+        n = len(self)
+
+        with prof.stage("crop", frames=n):
+            cropped_frames = [img.crop_frame(frame, crop_region)
+                              for frame in self.get_queue()]
+            self.store_processed_queue(cropped_frames, "crop")
 
         # resized_frames = [img.resize_frame(frame, resize_dim)
         #                        for frame in self.get_last_processed_queue()]
         # self.store_processed_queue(resized_frames, "resize")
 
-        grayscale_frames = [img.convert_grayscale(frame)
-                            for frame in self.get_last_processed_queue()]
-        self.store_processed_queue(grayscale_frames, "grayscale")
+        with prof.stage("grayscale", frames=n):
+            grayscale_frames = [img.convert_grayscale(frame)
+                                for frame in self.get_last_processed_queue()]
+            self.store_processed_queue(grayscale_frames, "grayscale")
 
     def segment_queue(self, min_seg_size, crop_region):
         """Apply image filtering methods to segment every frame in
         queue, storing every stage individually."""
 
-        rpca_frames = img.rpca(self.get_last_processed_queue())
-        self.store_processed_queue(rpca_frames, "RPCA")
+        n = len(self)
 
-        bilateral_frames = [img.bilateral_blur(frame, 7, 15, 1)
-                            for frame in self.get_last_processed_queue()]
-        self.store_processed_queue(bilateral_frames, "bilateral")
+        with prof.stage("rpca", frames=n):
+            rpca_frames = img.rpca(self.get_last_processed_queue())
+            self.store_processed_queue(rpca_frames, "RPCA")
 
-        thresh_frames = [img.thresh_to_zero(frame, 15)
-                         for frame in self.get_last_processed_queue()]
-        self.store_processed_queue(thresh_frames, "thresh_15")
+        with prof.stage("bilateral", frames=n):
+            d, sigma_color, sigma_space = SEGMENTATION_PARAMS["bilateral"]
+            bilateral_frames = [img.bilateral_blur(frame, d,
+                                                   sigma_color, sigma_space)
+                                for frame in self.get_last_processed_queue()]
+            self.store_processed_queue(bilateral_frames, "bilateral")
 
-        opened_frames = [img.grayscale_opening(frame, (3, 3))
-                         for frame in self.get_last_processed_queue()]
-        self.store_processed_queue(opened_frames, "opened")
-
-        labeled_frames = [img.cc_labeling(frame, 4)
-                          for frame in self.get_last_processed_queue()]
-        self.store_processed_queue(labeled_frames, "cc_labeling")
+        with prof.stage("threshold", frames=n):
+            thresh_frames = [img.thresh_to_zero(frame,
+                                                SEGMENTATION_PARAMS["thresh"])
+                             for frame in self.get_last_processed_queue()]
+            self.store_processed_queue(thresh_frames, "thresh_15")
 
-        regionprops_lists = [img.get_segment_properties(frame)
+        with prof.stage("opening", frames=n):
+            opened_frames = [img.grayscale_opening(
+                                 frame, SEGMENTATION_PARAMS["opening"])
                              for frame in self.get_last_processed_queue()]
-        segment_images = [img.extract_segment_images(regionprops_list,
-                                                     frame, min_seg_size,
-                                                     crop_region)
-                          for frame, regionprops_list
-                          in zip(self.get_queue(), regionprops_lists)]
-        self.store_segmented_queue(regionprops_lists, segment_images)
+            self.store_processed_queue(opened_frames, "opened")
+
+        with prof.stage("labeling", frames=n):
+            labeled_frames = [img.cc_labeling(
+                                  frame, SEGMENTATION_PARAMS["connectivity"])
+                              for frame in self.get_last_processed_queue()]
+            self.store_processed_queue(labeled_frames, "cc_labeling")
+
+        with prof.stage("regionprops", frames=n):
+            regionprops_lists = [img.get_segment_properties(frame)
+                                 for frame in self.get_last_processed_queue()]
+            segment_images = [img.extract_segment_images(regionprops_list,
+                                                         frame, min_seg_size,
+                                                         crop_region)
+                              for frame, regionprops_list
+                              in zip(self.get_queue(), regionprops_lists)]
+            self.store_segmented_queue(regionprops_lists, segment_images)
+
+        prof.count("segments", sum(len(regionprops_list)
+                                   for regionprops_list in regionprops_lists))
+
+
+def get_batch_size(queue_size, frames_remaining):
+    """Number of frames to segment next. The final batch is only as
+    long as the number of frames remaining (rather than being padded
+    with empty frames), and is extended to avoid leaving a final batch
+    shorter than MIN_QUEUE_SIZE."""
+
+    if frames_remaining - queue_size < MIN_QUEUE_SIZE:
+        return frames_remaining
+
+    return queue_size
+
+
+class QueueSizeTuner:
+    """Chooses how many frames are segmented at once (the window used by
+    RPCA) by measuring each candidate size on the video being processed.
+    RPCA's cost per frame grows with the window size, but windows which
+    are too short can absorb slow-moving birds into the background.
+
+    Candidates are tried in turn (interleaved, so that changes in video
+    content affect every candidate equally). The fastest candidate is
+    then chosen, among those whose segments per frame stays within a
+    tolerance of the default size's. Tuning is periodically repeated, as
+    conditions can change over the course of a video (e.g. lighting)."""
+
+    def __init__(self, default_size=21, candidates=(13, 17, 21, 27, 33),
+                 trials=3, tolerance=0.25, retune_interval=500):
+        self.default_size = default_size
+        self.candidates = sorted(set(candidates) | {default_size})
+        self.trials = trials
+        self.tolerance = tolerance
+        self.retune_interval = retune_interval
+
+        self.best_size = default_size
+        self.reset()
+
+    def reset(self):
+        self.schedule = [size for _ in range(self.trials)
+                         for size in self.candidates]
+        self.stats = {size: {"seconds": 0.0, "frames": 0, "segments": 0}
+                      for size in self.candidates}
+        self.batches_since_tuning = 0
+
+    def next_size(self):
+        if self.schedule:
+            return self.schedule[0]
+
+        return self.best_size
+
+    def update(self, queue_size, seconds, n_frames, n_segments):
+        """Record the cost of segmenting a batch. Returns True if a new
+        size was chosen."""
+
+        # Shortened final batches aren't representative of their size
+        if n_frames != queue_size:
+            return False
+
+        if self.schedule and queue_size == self.schedule[0]:
+            self.schedule.pop(0)
+            stats = self.stats[queue_size]
+            stats["seconds"] += seconds
+            stats["frames"] += n_frames
+            stats["segments"] += n_segments
+
+            if not self.schedule:
+                self.best_size = self.choose_size()
+                return True
+
+        elif self.retune_interval > 0:
+            self.batches_since_tuning += 1
+            if self.batches_since_tuning >= self.retune_interval:
+                self.reset()
+
+        return False
+
+    def choose_size(self):
+        def segments_per_frame(size):
+            return self.stats[size]["segments"] / self.stats[size]["frames"]
+
+        def seconds_per_frame(size):
+            return self.stats[size]["seconds"] / self.stats[size]["frames"]
+
+        # Allow half a segment per frame of slack for near-empty scenes
+        reference = segments_per_frame(self.default_size)
+        stable_sizes = [size for size in self.candidates
+                        if abs(segments_per_frame(size) - reference)
+                        <= self.tolerance * reference + 0.5]
+
+        return min(stable_sizes, key=seconds_per_frame)
+
+    def get_cost(self, queue_size):
+        stats = self.stats[queue_size]
+        return 1000 * stats["seconds"] / max(stats["frames"], 1)
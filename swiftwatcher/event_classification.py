@@ -44,14 +44,81 @@ def convert_events_to_dataframe(event_list, attributes_to_keep):
     return df_events
 
 
+def convert_events_to_arrays(event_list):
+    """Converts list of detected events into flat NumPy arrays, with
+    one entry per segment across all events:
+        -event_id:   Index of the event the segment belongs to.
+        -step:       Position of the segment within its event.
+        -frame:      Frame number the segment was found in.
+        -centroid_y, centroid_x: Coordinates of the segment's centroid.
+
+    Per-event arrays are also included:
+        -offsets:    Index of each event's first segment, plus a final
+                     entry equal to the total number of segments.
+        -framenumber, timestamp: Frame number and timestamp of each
+                     event's last segment (i.e. when the event occurred).
+
+    This avoids building per-segment dictionaries, which is slow when
+    there are tens of thousands of events."""
+
+    lengths = np.array([len(event) for event in event_list], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+    segments = [segment for event in event_list for segment in event]
+    centroids = np.array([segment.centroid for segment in segments],
+                         dtype=np.float64).reshape(-1, 2)
+
+    return {
+        "event_id": np.repeat(np.arange(len(event_list)), lengths),
+        "step": np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths),
+        "frame": np.array([segment.parent_frame_number
+                           for segment in segments], dtype=np.int64),
+        "centroid_y": centroids[:, 0],
+        "centroid_x": centroids[:, 1],
+        "offsets": offsets,
+        "framenumber": np.array([event[-1].parent_frame_number
+                                 for event in event_list], dtype=np.int64),
+        "timestamp": [event[-1].parent_timestamp for event in event_list],
+    }
+
+
+def generate_angle_features_from_arrays(event_arrays):
+    """Vectorized equivalent of generate_angle_features, using the
+    output of convert_events_to_arrays. The event_id column is kept so
+    that features can be matched back to their events."""
+
+    first = event_arrays["offsets"][:-1]
+    last = event_arrays["offsets"][1:] - 1
+
+    del_y = (event_arrays["centroid_y"][first] -
+             event_arrays["centroid_y"][last])
+    del_x = -1 * (event_arrays["centroid_x"][first] -
+                  event_arrays["centroid_x"][last])
+
+    index = pd.MultiIndex.from_arrays([event_arrays["timestamp"],
+                                       event_arrays["framenumber"]],
+                                      names=["timestamp", "framenumber"])
+    df_features = pd.DataFrame({"event_id": np.arange(len(first)),
+                                "angle": np.degrees(np.arctan2(del_y, del_x))},
+                               index=index)
+
+    return df_features
+
+
 def classify_events(df_events):
     """Take detected events and use their features to classify
     whether those events should truly be counted as a swift entering
     the chimney."""
 
-    df_features = generate_angle_features(df_events)
+    return classify_features(generate_angle_features(df_events))
+
+
+def classify_features(df_features, window=30):
+    """Classify events using previously generated feature vectors.
+    (See generate_angle_features/generate_angle_features_from_arrays.)"""
+
     df_features_filtered = filter_false_angles(df_features)
-    df_labels = generate_classifications(df_features_filtered)
+    df_labels = generate_classifications(df_features_filtered, window)
 
     # Add event count (used for when multiple events occur in a single
     # timestamp -- when rows are merged, "events" can display as > 1)
@@ -92,37 +159,52 @@ def filter_false_angles(df_features):
     unnatural segments themselves."""
 
     # Correct false positive errors from small (3x3 opened) non-bird segments
-    index_to_drop = df_features[(df_features["angle"] % 15 == 0)].index
-    if not index_to_drop.empty:
-        df_features = df_features.drop(
-            df_features[(df_features["angle"] % 15 == 0)].index)
-
-    return df_features
+    return df_features[df_features["angle"] % 15 != 0]
 
 
-def generate_classifications(df_features):
+def generate_classifications(df_features, window=30):
     """Classify "segment disappeared" events based on corresponding feature
     vectors."""
 
     mode = compute_mode(df_features)
 
     df_labels = df_features.copy()
-    df_labels["label"] = np.array([0, 1, 0])[pd.cut(df_features["angle"],
-                                             bins=[-180 - EPSILON,
-                                                   mode - 30,
-                                                   mode + 30,
-                                                   180 + EPSILON],
-                                             labels=False)]
+    df_labels["label"] = label_angles(df_features["angle"], mode, window)
 
     return df_labels
 
 
+def label_angles(angles, mode, window=30):
+    """Label angles within 'window' degrees of the mode as 1 (swift
+    entered chimney), and all other angles as 0."""
+
+    # Window is clamped to the range of angles, as bins must increase
+    lower = max(mode - window, np.nextafter(-180, -np.inf))
+    upper = min(mode + window, 180)
+    bins = pd.cut(angles, bins=[-np.inf, lower, upper, np.inf], labels=False)
+
+    return np.array([0, 1, 0])[np.asarray(bins, dtype=np.int64)]
+
+
 def compute_mode(df_features):
     """Mode for continuous variables. For more information, see:
     https://www.mathstips.com/mode/ """
 
-    hist, bin_edges = np.histogram(df_features["angle"], bins=36,
-                                   range=[-180 - EPSILON, 180 + EPSILON])
+    hist, bin_edges = compute_histogram(df_features["angle"])
+
+    return mode_from_histogram(hist, bin_edges)
+
+
+def compute_histogram(angles):
+    """Compute the 36-bin histogram of event angles used to estimate
+    the mode. Histograms of separate sets of angles can be summed."""
+
+    return np.histogram(angles, bins=36,
+                        range=[-180 - EPSILON, 180 + EPSILON])
+
+
+def mode_from_histogram(hist, bin_edges):
+    """Estimate the mode of event angles from their histogram."""
 
     # mode for continuous variables: https://www.mathstips.com/mode/
     i_max = np.argmax(hist)
@@ -139,3 +221,61 @@ def compute_mode(df_features):
         estimated_mode = -90
 
     return estimated_mode
+
+
+class IncrementalEventClassifier:
+    """Classifies events as they are detected, rather than after the
+    entire video has been processed. A running histogram of event
+    angles is kept, so that the mode (and therefore the labels) can be
+    estimated at any point during processing.
+
+    Labels are provisional, as the mode can shift as more events are
+    seen. Labels from finalize() match those of classify_features()."""
+
+    def __init__(self):
+        self.histogram = np.zeros(36, dtype=np.int64)
+        self.bin_edges = compute_histogram([])[1]
+        self.n_events = 0
+
+        self.angles = []
+        self.timestamps = []
+        self.framenumbers = []
+
+    def update(self, new_events):
+        """Add a list of newly detected events to the classifier."""
+
+        if not new_events:
+            return
+
+        df_features = filter_false_angles(generate_angle_features_from_arrays(
+            convert_events_to_arrays(new_events)))
+
+        self.histogram += compute_histogram(df_features["angle"])[0]
+        self.angles.append(df_features["angle"].values)
+        self.timestamps.append(df_features.index.get_level_values(0))
+        self.framenumbers.append(df_features.index.get_level_values(1))
+        self.n_events += len(new_events)
+
+    def get_mode(self):
+        return mode_from_histogram(self.histogram, self.bin_edges)
+
+    def provisional_labels(self):
+        """Label every event seen so far using the current mode."""
+
+        index = pd.MultiIndex.from_arrays(
+            [np.concatenate(self.timestamps or [[]]),
+             np.concatenate(self.framenumbers or [[]]).astype(np.int64)],
+            names=["timestamp", "framenumber"])
+        angles = np.concatenate(self.angles or [[]])
+
+        df_labels = pd.DataFrame({"angle": angles}, index=index)
+        df_labels["label"] = label_angles(angles, self.get_mode())
+        df_labels["events"] = 1
+
+        return df_labels
+
+    def finalize(self):
+        """Final reconciliation, once every event has been seen. All
+        events are relabeled using the mode of the full histogram."""
+
+        return self.provisional_labels()
@@ -11,6 +11,8 @@ import math
 from scipy import ndimage
 from skimage import measure
 
+import swiftwatcher.profiling as prof
+
 
 ###############################################################################
 #                  CROPPING/ROI REGION FUNCTIONS BEGIN HERE                   #
@@ -281,7 +283,8 @@ def inexact_augmented_lagrange_multiplier(X, lmbda=0.01, tol=0.001,
     while True:
         Eraw = X - A + (1 / mu) * Y
         Eupdate = np.maximum(Eraw - lmbda / mu, 0) + np.minimum(Eraw + lmbda / mu, 0)
-        U, S, V = svd(X - Eupdate + (1 / mu) * Y, full_matrices=False)
+        with prof.stage("rpca_svd"):
+            U, S, V = svd(X - Eupdate + (1 / mu) * Y, full_matrices=False)
         svp = (S > 1 / mu).shape[0]
         if svp < sv:
             sv = np.min([svp + 1, n])
@@ -296,6 +299,7 @@ def inexact_augmented_lagrange_multiplier(X, lmbda=0.01, tol=0.001,
         itr += 1
         if ((norm(Z, 'fro') / dnorm) < tol) or (itr >= maxiter):
             break
+    prof.count("rpca_iterations", itr)
     if verbose:
         print("Finished at iteration %d" % (itr))
     return A, E
@@ -367,3 +371,54 @@ def extract_segment_images(segments, frame, min_seg_size, crop_region):
         segment_images.append(color_seg)
 
     return segment_images
+
+
+def get_segment_features(segments):
+    """Compute cheap shape features for a list of segments, returned as
+    an (N, 3) array with columns:
+        -area:      Number of pixels within the segment.
+        -aspect:    Ratio of the longer to shorter side of the bbox.
+        -intensity: Mean grayscale intensity of the segment image."""
+
+    features = np.zeros((len(segments), 3))
+
+    for i, segment in enumerate(segments):
+        height = segment.bbox[2] - segment.bbox[0]
+        width = segment.bbox[3] - segment.bbox[1]
+
+        features[i, 0] = segment.area
+        features[i, 1] = max(height, width) / max(min(height, width), 1)
+        features[i, 2] = np.mean(convert_grayscale(segment.segment_image))
+
+    return features
+
+
+def resize_patches(images, size):
+    """Resize a list of (H, W, 3) uint8 images into a preallocated
+    (N, size, size, 3) uint8 array. Patches are usually already at the
+    minimum segment size, in which case they are copied as-is.
+
+    Patches which shrink along either axis (e.g. 40x20) use area
+    interpolation to avoid aliasing, and only patches which purely grow
+    use bilinear interpolation.
+
+    Note: PIL's antialiased bilinear filter and OpenCV's area
+    interpolation are not bit-identical when shrinking patches larger
+    than the minimum segment size, so those patches may differ slightly
+    from the PIL transforms used to train the segment classifier."""
+
+    patches = np.empty((len(images), size, size, 3), dtype=np.uint8)
+
+    for i, image in enumerate(images):
+        if image.shape[:2] == (size, size):
+            patches[i] = image
+        elif image.shape[0] > size or image.shape[1] > size:
+            patches[i] = cv2.resize(np.ascontiguousarray(image),
+                                    (size, size),
+                                    interpolation=cv2.INTER_AREA)
+        else:
+            patches[i] = cv2.resize(np.ascontiguousarray(image),
+                                    (size, size),
+                                    interpolation=cv2.INTER_LINEAR)
+
+    return patches
@@ -0,0 +1,496 @@
+"""
+    Contains functionality for caching intermediate output on disk, so
+    that later stages of the algorithm can be re-run without repeating
+    expensive earlier stages. (e.g. replaying tracking/classification
+    from cached segmentation output, rather than recomputing RPCA.)
+    Final results are cached as well, so that unchanged videos are never
+    re-analysed.
+"""
+
+from pathlib import Path
+import hashlib
+import shutil
+import json
+import os
+import pickle
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+import swiftwatcher.data_structures as ds
+import swiftwatcher.image_filtering as img
+import swiftwatcher.segment_tracking as st
+
+# Incremented whenever the segmentation output changes for the same input
+SEGMENTATION_VERSION = 2
+
+# Incremented whenever results change for the same segmentation output
+RESULTS_VERSION = 1
+
+# Command-line options which affect the contents of exported results
+RESULT_OPTIONS = ["classify", "prefilter", "quantized", "full_usec",
+                  "parquet"]
+
+# Options which produce outputs other than results, so can't be skipped
+UNCACHED_OPTIONS = ["export", "cache_segments", "profile", "memory", "live"]
+
+DEFAULT_RESULT_CACHE_DIR = Path.home() / ".cache" / "swiftwatcher" / "results"
+
+# Segment classifier weights. (Matches sc.MODEL_PATH, which isn't
+# imported to avoid importing torch.)
+MODEL_PATH = Path(__file__).parent / "model.pt"
+QUANTIZED_MODEL_PATH = Path(__file__).parent / "model.int8.torchscript.pt"
+
+# Size of stored segment image patches (matches min_seg_size)
+PATCH_SIZE = 24
+
+# Per-segment datasets of a segment cache (patches are optional)
+SEGMENT_DATASETS = ["centroid", "bbox", "area", "label", "patch"]
+
+
+###############################################################################
+#                         CACHE KEY FUNCTIONS BEGIN HERE                      #
+###############################################################################
+
+
+def hash_file(filepath, sample_size=2**20):
+    """Compute a fast content hash of a file. Rather than reading the
+    entire file (which can be many GB for a video), the file's size and
+    samples from its start, middle and end are hashed."""
+
+    file_size = os.path.getsize(str(filepath))
+    hasher = hashlib.blake2b(str(file_size).encode(), digest_size=16)
+
+    with open(str(filepath), "rb") as f:
+        for offset in [0, max(0, file_size//2 - sample_size//2),
+                       max(0, file_size - sample_size)]:
+            f.seek(offset)
+            hasher.update(f.read(sample_size))
+
+    return hasher.hexdigest()
+
+
+def hash_parameters(parameters):
+    """Compute a hash of a JSON-serializable dictionary of parameters."""
+
+    serialized = json.dumps(parameters, sort_keys=True, default=str)
+
+    return hashlib.blake2b(serialized.encode(), digest_size=16).hexdigest()
+
+
+def segment_cache_key(src_filepath, corners, start, end, queue_size):
+    """Key which identifies segmentation output: combines the video's
+    content, the chimney corners, the frame range and every parameter
+    which affects segmentation. (queue_size is "adaptive" if the queue
+    size is tuned at runtime.)"""
+
+    return hash_parameters({
+        "video": hash_file(src_filepath),
+        "corners": [list(corner) for corner in corners],
+        "range": [start, end],
+        "queue_size": queue_size,
+        "params": ds.SEGMENTATION_PARAMS,
+        "version": SEGMENTATION_VERSION,
+    })
+
+
+def get_queue_size_key(args):
+    # Queue size is never tuned when segmenting in worker processes
+    if args.adaptive_queue and args.workers == 0:
+        return "adaptive"
+
+    return args.queue_size
+
+
+def get_segment_cache_path(output_dir, key):
+    return output_dir / "segment_cache" / "{}.h5".format(key)
+
+
+def get_result_options(args):
+    """Options which affect results, for use in cache and checkpoint
+    keys (so that results from different settings are never mixed)."""
+
+    options = {name: getattr(args, name) for name in RESULT_OPTIONS}
+
+    # Prefilter thresholds are stored in a file which may be re-fitted.
+    # (Default is sc.PREFILTER_PATH, which isn't imported to avoid torch.)
+    prefilter_path = args.prefilter
+    if prefilter_path == "default":
+        prefilter_path = Path(__file__).parent / "prefilter.json"
+    if prefilter_path is not None and Path(prefilter_path).is_file():
+        options["prefilter"] = hash_file(prefilter_path)
+
+    # Likewise, the model may be retrained or re-quantized
+    if args.classify:
+        model_path = QUANTIZED_MODEL_PATH if args.quantized else MODEL_PATH
+        if model_path.is_file():
+            options["model"] = hash_file(model_path)
+
+    return options
+
+
+def result_cache_key(src_filepath, corners, start, end, args):
+    """Key which identifies the results of an entire run: combines the
+    segmentation key with every parameter and option which affects the
+    exported results."""
+
+    return hash_parameters({
+        "segments": segment_cache_key(src_filepath, corners, start, end,
+                                      get_queue_size_key(args)),
+        "tracking": st.TRACKING_PARAMS,
+        "options": get_result_options(args),
+        "version": RESULTS_VERSION,
+    })
+
+
+###############################################################################
+#                       SEGMENTATION CACHE BEGINS HERE                        #
+###############################################################################
+
+
+class SegmentCacheWriter:
+    """Writes the segments of every frame to a chunked HDF5 file as
+    frames are segmented. Per-frame and per-segment tables are stored
+    as resizable datasets, so the full cache never needs to be held in
+    memory. The file only appears at its final path once closed, so an
+    interrupted run never leaves behind a partial cache."""
+
+    def __init__(self, filepath, roi_mask, crop_region, fps,
+                 store_patches=True):
+        import h5py
+
+        self.filepath = Path(filepath)
+        self.tmp_filepath = self.filepath.with_suffix(".tmp")
+        if not self.filepath.parent.exists():
+            Path.mkdir(self.filepath.parent, parents=True)
+
+        self.h5_file = h5py.File(str(self.tmp_filepath), "w")
+        self.h5_file.attrs["fps"] = fps
+        self.h5_file.attrs["crop_region"] = np.array(crop_region)
+        self.h5_file.create_dataset("roi_mask", data=roi_mask,
+                                    compression="lzf")
+
+        self.datasets = {}
+        self.create_dataset("frame_number", (), np.int64)
+        self.create_dataset("timestamp_us", (), np.int64)
+        self.create_dataset("segment_offset", (), np.int64)
+        self.create_dataset("centroid", (2,), np.float64)
+        self.create_dataset("bbox", (4,), np.int64)
+        self.create_dataset("area", (), np.int64)
+        self.create_dataset("label", (), np.int64)
+        if store_patches:
+            self.create_dataset("patch", (PATCH_SIZE, PATCH_SIZE, 3), np.uint8)
+
+        self.n_segments = 0
+
+    def create_dataset(self, name, shape, dtype):
+        self.datasets[name] = self.h5_file.create_dataset(
+            name, shape=(0,) + shape, maxshape=(None,) + shape, dtype=dtype,
+            chunks=(4096,) + shape, compression="lzf")
+
+    def append(self, name, values):
+        dataset = self.datasets[name]
+        n = dataset.shape[0]
+        dataset.resize(n + len(values), axis=0)
+        dataset[n:] = values
+
+    def write_frames(self, frames):
+        """Append the segments of a list of frames to the cache."""
+
+        segments = [segment for frame in frames for segment in frame.segments]
+        n_segments = [len(frame.segments) for frame in frames]
+
+        self.append("frame_number", [frame.frame_number for frame in frames])
+        self.append("timestamp_us", [timestamp_to_microseconds(frame)
+                                     for frame in frames])
+        self.append("segment_offset",
+                    self.n_segments + np.cumsum([0] + n_segments[:-1]))
+        self.n_segments += len(segments)
+
+        if segments:
+            self.append("centroid", [segment.centroid for segment in segments])
+            self.append("bbox", [segment.bbox for segment in segments])
+            self.append("area", [segment.area for segment in segments])
+            self.append("label", [segment.label for segment in segments])
+            if "patch" in self.datasets:
+                self.append("patch", img.resize_patches(
+                    [segment.segment_image for segment in segments],
+                    PATCH_SIZE))
+
+    def close(self):
+        self.h5_file.attrs["n_segments"] = self.n_segments
+        self.h5_file.close()
+        os.replace(str(self.tmp_filepath), str(self.filepath))
+
+    def discard(self):
+        """Close and remove an incomplete cache. (Safe to call more than
+        once, e.g. by both a failed generator and its caller.)"""
+
+        if self.tmp_filepath.exists():
+            self.h5_file.close()
+            os.remove(str(self.tmp_filepath))
+
+
+class SegmentCacheReader:
+    """Reads segmentation output written by SegmentCacheWriter and
+    replays it as Frame objects, which can be passed directly to the
+    tracking and classification stages. Segments are read one batch of
+    frames at a time, so the cache (in particular its patches) is never
+    held in memory in full. Patches aren't read at all unless needed
+    (e.g. they are only needed for classification, not tracking)."""
+
+    def __init__(self, filepath, load_patches=True):
+        import h5py
+
+        self.filepath = Path(filepath)
+        self.load_patches = load_patches
+        with h5py.File(str(filepath), "r") as h5_file:
+            self.fps = h5_file.attrs["fps"]
+            self.crop_region = [tuple(corner) for corner
+                                in h5_file.attrs["crop_region"]]
+            self.roi_mask = h5_file["roi_mask"][()]
+            self.total_frames = len(h5_file["frame_number"])
+
+    def iter_frames(self):
+        """Yield frames (with segments, but not frame images) in the
+        order they were originally segmented."""
+
+        for batch in self.iter_frame_batches():
+            yield from batch
+
+    def iter_frame_batches(self, batch_size=21):
+        """Yield lists of frames, to mirror batches from a FrameQueue."""
+
+        import h5py
+
+        with h5py.File(str(self.filepath), "r") as h5_file:
+            # Per-frame tables are small, so they are read in full
+            frame_numbers = h5_file["frame_number"][()]
+            timestamps = h5_file["timestamp_us"][()]
+            offsets = np.append(h5_file["segment_offset"][()],
+                                len(h5_file["area"]))
+
+            for start in range(0, len(frame_numbers), batch_size):
+                end = min(start + batch_size, len(frame_numbers))
+                yield self.read_frames(h5_file, frame_numbers[start:end],
+                                       timestamps[start:end],
+                                       offsets[start:end + 1])
+
+    def read_frames(self, h5_file, frame_numbers, timestamps, offsets):
+        """Read the segments of consecutive frames, where offsets[i] is
+        the index of frame i's first segment (and offsets[-1] is the
+        index after the last frame's final segment)."""
+
+        first, last = int(offsets[0]), int(offsets[-1])
+        data = {name: h5_file[name][first:last]
+                for name in SEGMENT_DATASETS if name in h5_file and
+                (name != "patch" or self.load_patches)}
+        patches = data.get("patch")
+
+        frames = []
+        for i, frame_number in enumerate(frame_numbers):
+            frame_number = int(frame_number)
+            timestamp = microseconds_to_timestamp(timestamps[i])
+            frame = ds.Frame(None, frame_number, timestamp)
+
+            for j in range(offsets[i] - first, offsets[i + 1] - first):
+                frame.segments.append(ds.Segment.from_attributes(
+                    frame_number, timestamp,
+                    patches[j] if patches is not None else None,
+                    {"centroid": tuple(data["centroid"][j]),
+                     "bbox": tuple(int(v) for v in data["bbox"][j]),
+                     "area": int(data["area"][j]),
+                     "label": int(data["label"][j])}))
+
+            frames.append(frame)
+
+        return frames
+
+
+def timestamp_to_microseconds(frame):
+    """Convert frame timestamps to integers, using -1 for null frames."""
+
+    if frame.null:
+        return -1
+
+    return (frame.timestamp - pd.Timestamp("00:00:00.000")) \
+        // pd.Timedelta(1, unit="us")
+
+
+def microseconds_to_timestamp(microseconds):
+    """Inverse of timestamp_to_microseconds."""
+
+    if microseconds < 0:
+        return ds.Frame().timestamp
+
+    return pd.Timestamp("00:00:00.000") + pd.Timedelta(int(microseconds),
+                                                       unit="us")
+
+
+###############################################################################
+#                          RESULT CACHE BEGINS HERE                           #
+###############################################################################
+
+
+class ResultCache:
+    """Stores the files exported for a run (see dio.export_results),
+    keyed by result_cache_key, so that a video which has already been
+    processed with the same corners and parameters can be skipped.
+
+    Each entry is a directory containing the result files and an
+    "entry.json" file, whose modification time records when the entry
+    was last used. Once the cache exceeds max_bytes, the least recently
+    used entries are evicted. Entries are written to a temporary
+    directory and then renamed, so concurrent processes sharing a cache
+    never see partial entries."""
+
+    def __init__(self, cache_dir=DEFAULT_RESULT_CACHE_DIR, max_bytes=10*2**30):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+
+    def get(self, key, output_dir):
+        """Copy a cached entry's files into output_dir. Returns the
+        list of restored filepaths, or None if the key isn't cached."""
+
+        entry_dir = self.cache_dir / key
+        try:
+            with open(str(entry_dir / "entry.json")) as json_file:
+                filenames = json.load(json_file)["filenames"]
+            os.utime(str(entry_dir / "entry.json"))
+
+            if not output_dir.exists():
+                Path.mkdir(output_dir, parents=True)
+            for filename in filenames:
+                shutil.copy2(str(entry_dir / filename),
+                             str(output_dir / filename))
+        except (OSError, ValueError, KeyError):
+            # Missing, corrupt, or evicted by another process while copying
+            return None
+
+        return [output_dir / filename for filename in filenames]
+
+    def put(self, key, filepaths, video_name=None):
+        """Store copies of the files exported for a run. An empty list
+        is valid, and records that a run exported nothing."""
+
+        if not self.cache_dir.exists():
+            Path.mkdir(self.cache_dir, parents=True)
+
+        tmp_dir = self.cache_dir / ".{}.{}.tmp".format(key, uuid.uuid4().hex)
+        Path.mkdir(tmp_dir)
+        for filepath in filepaths:
+            shutil.copy2(str(filepath), str(tmp_dir / filepath.name))
+        with open(str(tmp_dir / "entry.json"), "w") as json_file:
+            json.dump({"filenames": [filepath.name for filepath in filepaths],
+                       "video": video_name, "created": time.time()},
+                      json_file)
+
+        try:
+            os.rename(str(tmp_dir), str(self.cache_dir / key))
+        except OSError:
+            # Another process has already stored this entry
+            shutil.rmtree(str(tmp_dir), ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits
+        within max_bytes."""
+
+        entries = []
+        for entry_dir in self.cache_dir.iterdir():
+            if entry_dir.name.startswith(".") or not entry_dir.is_dir():
+                continue
+            try:
+                last_used = (entry_dir / "entry.json").stat().st_mtime
+                size = sum(path.stat().st_size
+                           for path in entry_dir.iterdir())
+            except OSError:
+                continue
+            entries.append((last_used, size, entry_dir))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            shutil.rmtree(str(entry_dir), ignore_errors=True)
+            total_size -= size
+
+
+###############################################################################
+#                          CHECKPOINTING BEGINS HERE                          #
+###############################################################################
+
+
+class Checkpointer:
+    """Periodically saves the state of a long-running analysis, so that
+    it can be resumed if the process is interrupted. State consists of
+    the next frame to be read, the tracker's cached frame (which holds
+    active tracks through its segments' histories) and the events
+    detected so far.
+
+    Checkpoints are only taken after a complete queue of frames has been
+    tracked, so resuming keeps the same queue boundaries (and therefore
+    the same RPCA output) as an uninterrupted run. (Unless the queue size
+    is adaptive, in which case the size is re-tuned after resuming.)"""
+
+    def __init__(self, filepath, key, interval=300):
+        self.filepath = Path(filepath)
+        self.key = key
+        self.interval = interval
+        self.last_save = time.monotonic()
+
+    def load(self):
+        """Return the saved state, or None if there is no checkpoint
+        for this video and set of parameters."""
+
+        if not self.filepath.is_file():
+            return None
+
+        with open(str(self.filepath), "rb") as f:
+            state = pickle.load(f)
+
+        if state["key"] != self.key:
+            print("[!] Checkpoint '{}' was created using different inputs "
+                  "or parameters, ignoring.".format(self.filepath))
+            return None
+
+        return state
+
+    def save_if_due(self, tracker):
+        if time.monotonic() - self.last_save >= self.interval:
+            self.save(tracker)
+
+    def save(self, tracker):
+        """Atomically save the tracker's state to the checkpoint file."""
+
+        cached_frame = tracker.get_cached_frame()
+        if cached_frame.null:
+            return
+
+        # Processed images aren't needed to resume tracking, only segments
+        frame = ds.Frame(None, cached_frame.frame_number,
+                         cached_frame.timestamp)
+        frame.segments = cached_frame.segments
+
+        state = {
+            "key": self.key,
+            "next_frame_number": cached_frame.frame_number + 1,
+            "cached_frame": frame,
+            "detected_events": tracker.detected_events,
+        }
+
+        if not self.filepath.parent.exists():
+            Path.mkdir(self.filepath.parent, parents=True)
+        tmp_filepath = self.filepath.with_suffix(".tmp")
+        with open(str(tmp_filepath), "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(str(tmp_filepath), str(self.filepath))
+
+        self.last_save = time.monotonic()
+
+    def remove(self):
+        if self.filepath.is_file():
+            os.remove(str(self.filepath))
@@ -6,60 +6,90 @@
 from pathlib import Path
 from glob import glob
 from datetime import date
+import json
 
 import numpy as np
 import pandas as pd
 
+# Event features saved by each shard of a video, for merging
+SHARD_FEATURES_FILENAME = "shard-features.csv"
+
 
 ###############################################################################
 #                        RESULTS EXPORTING BEGINS HERE                        #
 ###############################################################################
 
 
-def export_results(save_directory, df_labels, fps, start, end):
+def export_results(save_directory, df_labels, fps, start, end,
+                   full_usec=False, event_arrays=None):
     """Modify event classification dataframe into form that is more suitable
-    for output, then save results to csv files."""
+    for output, then save results to csv files.
+
+    Per-second and per-minute counts are computed directly from event
+    frame numbers, so a table covering every frame of the video is only
+    created (and streamed to disk in chunks) if full_usec is True.
+
+    If event_arrays (see ec.convert_events_to_arrays) are provided, a
+    single columnar results file is saved as well."""
 
     print("[-]     Saving results to csv files...")
-    df_empty = create_empty_dataframe(fps, start, end)
-    predicted, rejected = split_labeled_events(df_labels)
-    total, minutes, seconds, exact = fill_and_group(df_empty,
-                                                    predicted, rejected)
-    save_to_csv(save_directory, total, minutes, seconds, exact)
+    df_exact = count_events_per_frame(df_labels)
+    df_seconds = count_events_per_period(df_labels, fps, start, end, 1)
+    df_minutes = count_events_per_period(df_labels, fps, start, end, 60)
+    total = int(np.sum(df_exact["predicted"]))
+
+    save_to_csv(save_directory, total, df_minutes, df_seconds, df_exact)
+    if full_usec:
+        save_full_usec_csv(save_directory, total, df_exact, fps, start, end)
+    if event_arrays is not None:
+        save_to_parquet(save_directory, total, df_labels, event_arrays,
+                        df_seconds, df_minutes, fps, start, end)
 
     return total
 
 
-def create_empty_dataframe(fps, start, end):
-    """Create empty dataframe containing every timestamp in video file."""
+def get_result_filepaths(save_directory, count, full_usec=False,
+                         parquet=False):
+    """List the files written by export_results for a given count."""
+
+    names = ["events-only_usec", "full_sec", "events-only_sec", "full_min",
+             "events-only_min"]
+    if full_usec:
+        names.append("full_usec")
+    filepaths = [save_directory/"{0}-swifts_{1}.csv".format(count, name)
+                 for name in names]
+    if parquet:
+        filepaths.append(save_directory/"{0}-swifts_results.parquet"
+                                        .format(count))
 
-    # Create Series of DateTimeIndex indices (i.e. frame timestamps)
-    nano = (1 / fps) * 1e9
-    num_timestamps = end - start + 1
-    duration = (num_timestamps - 1) * nano
+    return filepaths
 
-    start_timestamp = (pd.Timestamp("00:00:00.000000") +
-                       pd.Timedelta(start * nano, 'ns'))
-    end_timestamp = (start_timestamp + pd.Timedelta(duration, 'ns'))
 
-    timestamps = pd.date_range(start=start_timestamp, end=end_timestamp,
-                               periods=num_timestamps)
-    timestamps = timestamps.round(freq='us')
+def save_shard_features(save_directory, df_features):
+    """Save the (unclassified) event features of one shard of a video,
+    so that every shard's events can be classified together once the
+    whole video has been processed. (See load_shard_features.)"""
 
-    # Create a Series of frame numbers which correspond to the timestamps
-    framenumbers = np.array(range(start, end + 1))
+    dataframe_to_csv(df_features[["angle"]],
+                     save_directory / SHARD_FEATURES_FILENAME)
 
-    # Combine frame numbers and timestamps into multi-index
-    tuples = list(zip(timestamps, framenumbers))
-    index = pd.MultiIndex.from_tuples(tuples,
-                                      names=['timestamp', 'framenumber'])
 
-    # Create an empty DataFrame for ground truth annotations to be put into
-    df_empty = pd.DataFrame(index=index)
-    df_empty["predicted"] = None
-    df_empty["rejected"] = None
+def load_shard_features(shards):
+    """Combine the event features saved for each shard of a video
+    (see wq.split_into_shards) into features for the whole video.
 
-    return df_empty
+    shards is a list of (shard directory, start, end) tuples, where
+    events are only taken from frames in [start, end), as overlapping
+    shards may both detect events near their boundary."""
+
+    dfs = []
+    for shard_dir, shard_start, shard_end in shards:
+        df_shard = dataframe_from_csv(Path(shard_dir) /
+                                      SHARD_FEATURES_FILENAME)
+        frames = df_shard.index.get_level_values("framenumber")
+        dfs.append(df_shard[(frames >= shard_start) & (frames < shard_end)])
+
+    return pd.concat(dfs).sort_index()
 
 
 def split_labeled_events(df_labels):
@@ -77,51 +107,68 @@ def split_labeled_events(df_labels):
                                                        'framenumber']).sum()
 
     # Drop unnecessary columns, and rename the remaining "EVENTS" column
-    df_rejected = df_rejected.drop(columns=["angle", "label"])
-    df_predicted = df_predicted.drop(columns=["angle", "label"])
+    df_rejected = df_rejected[["events"]]
+    df_predicted = df_predicted[["events"]]
     df_rejected.columns = ["rejected"]
     df_predicted.columns = ["predicted"]
 
     return df_predicted, df_rejected
 
 
-def fill_and_group(df_empty, df_predicted, df_rejected):
-    """Fill previously created empty dataframe with timestamps of detected
-    events. Then, create dataframes corresponding to different timestamp
-    groupings (e.g. per-minute counts, per-second counts, and exact
-    microsecond counts.)"""
+def count_events_per_frame(df_labels):
+    """Create a dataframe of predicted/rejected counts for only those
+    frames which contain events."""
+
+    df_predicted, df_rejected = split_labeled_events(df_labels)
+    df_exact = df_predicted.join(df_rejected, how="outer").fillna(0)
+
+    return df_exact.astype(int).sort_index()
 
-    # Fill empty values with detected events
-    df_empty = df_empty.combine_first(df_rejected)
-    df_empty = df_empty.combine_first(df_predicted)
-    df_empty = df_empty.fillna(0)
 
-    # Create dataframes for each time period grouping
-    df_exact = df_empty.copy(deep=True)
+def count_events_per_period(df_labels, fps, start, end, period):
+    """Count predicted/rejected events within every period (in seconds)
+    of the video, using integer binning of event frame numbers."""
 
-    df_seconds = df_empty.copy(deep=True)
-    df_seconds = \
-        df_seconds.set_index(df_seconds.index.levels[0].floor('s'))
-    df_seconds = df_seconds.groupby(df_seconds.index).sum()
+    period_us = int(period * 1e6)
+    first_bin = frames_to_microseconds(start, fps) // period_us
+    n_bins = frames_to_microseconds(end, fps) // period_us - first_bin + 1
 
-    df_minutes = df_empty.copy(deep=True)
-    df_minutes = \
-        df_minutes.set_index(df_minutes.index.levels[0].floor('min'))
-    df_minutes = df_minutes.groupby(df_minutes.index).sum()
+    frame_numbers = df_labels.index.get_level_values("framenumber")
+    bins = frames_to_microseconds(frame_numbers, fps) // period_us - first_bin
+    is_predicted = df_labels["label"].values > 0
 
-    # Calculate the total number of predicted swifts
-    df_total = int(np.sum(df_exact["predicted"]))
+    index = microseconds_to_timestamps((first_bin + np.arange(n_bins))
+                                       * period_us)
+    df_counts = pd.DataFrame({
+        "predicted": np.bincount(bins[is_predicted], minlength=n_bins),
+        "rejected": np.bincount(bins[~is_predicted], minlength=n_bins),
+    }, index=index)
 
-    return df_total, df_minutes, df_seconds, df_exact
+    return df_counts
+
+
+def frames_to_microseconds(frame_numbers, fps):
+    """Convert frame numbers into integer in-video times (in us)."""
+
+    return np.round(np.asarray(frame_numbers, dtype=np.float64)
+                    * 1e6 / fps).astype(np.int64)
+
+
+def microseconds_to_timestamps(microseconds):
+    """Convert integer in-video times (in us) into a DatetimeIndex,
+    using the same origin as FrameReader.frame_number_to_timestamp."""
+
+    origin = pd.Timestamp("00:00:00.000000")
+
+    return pd.DatetimeIndex(origin + pd.to_timedelta(microseconds, unit="us"),
+                            name="timestamp")
 
 
 def save_to_csv(save_directory, count, df_minutes, df_seconds, df_exact):
     """Save counts to csv files in a variety of different formats."""
 
     dfs = {
-        "full_usec": df_exact,
-        "events-only_usec": df_exact[~((df_exact["predicted"] == 0) &
-                                       (df_exact["rejected"] == 0))],
+        "events-only_usec": df_exact,
         "full_sec": df_seconds,
         "events-only_sec": df_seconds[~((df_seconds["predicted"] == 0) &
                                         (df_seconds["rejected"] == 0))],
@@ -135,6 +182,118 @@ def save_to_csv(save_directory, count, df_minutes, df_seconds, df_exact):
                                      .format(count, df_name)))
 
 
+def save_full_usec_csv(save_directory, count, df_exact, fps, start, end,
+                       chunk_size=100000):
+    """Save counts for every frame of the video to a csv file. Rows are
+    generated and written in chunks to limit memory usage."""
+
+    filepath = save_directory/"{0}-swifts_full_usec.csv".format(count)
+    event_frames = df_exact.index.get_level_values("framenumber").values
+
+    for chunk_start in range(start, end + 1, chunk_size):
+        framenumbers = np.arange(chunk_start,
+                                 min(chunk_start + chunk_size, end + 1))
+        timestamps = microseconds_to_timestamps(
+            frames_to_microseconds(framenumbers, fps))
+
+        df_chunk = pd.DataFrame({"predicted": 0, "rejected": 0},
+                                index=pd.MultiIndex.from_arrays(
+                                    [timestamps, framenumbers],
+                                    names=["timestamp", "framenumber"]))
+
+        # Fill in counts for frames in this chunk which contain events
+        in_chunk = ((event_frames >= framenumbers[0]) &
+                    (event_frames <= framenumbers[-1]))
+        positions = event_frames[in_chunk] - framenumbers[0]
+        df_chunk.iloc[positions, 0] = df_exact["predicted"].values[in_chunk]
+        df_chunk.iloc[positions, 1] = df_exact["rejected"].values[in_chunk]
+
+        df_chunk.to_csv(str(filepath), mode="w" if chunk_start == start
+                        else "a", header=(chunk_start == start))
+
+
+def save_to_parquet(save_directory, count, df_labels, event_arrays,
+                    df_seconds, df_minutes, fps, start, end):
+    """Save the classified events and aggregate counts to a single
+    Parquet file. Each event row stores its frame numbers and centroids
+    as native list columns, so no string parsing is needed to reload
+    them. Aggregate counts are stored in the file's metadata. (See
+    results_from_parquet.)"""
+
+    # Optional dependency, only needed when Parquet output is requested
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Arrow list arrays use 32-bit offsets into a flat array of values
+    offsets = event_arrays["offsets"].astype(np.int32)
+    n_segments = offsets[-1]
+    coordinates = np.stack([event_arrays["centroid_y"],
+                            event_arrays["centroid_x"]], axis=1).ravel()
+    points = pa.ListArray.from_arrays(
+        np.arange(0, 2*n_segments + 1, 2, dtype=np.int32), coordinates)
+
+    # Only events which were classified (i.e. not filtered) are kept
+    event_ids = pa.array(df_labels["event_id"].values)
+    frames = pa.ListArray.from_arrays(offsets, event_arrays["frame"])
+    centroids = pa.ListArray.from_arrays(offsets, points)
+
+    table = pa.Table.from_pandas(df_labels.reset_index(), preserve_index=False)
+    table = table.append_column("frames", frames.take(event_ids))
+    table = table.append_column("centroid", centroids.take(event_ids))
+
+    attributes = {
+        "fps": fps, "start": int(start), "end": int(end), "count": count,
+        "seconds": aggregate_to_dict(df_seconds),
+        "minutes": aggregate_to_dict(df_minutes),
+    }
+    table = table.replace_schema_metadata(
+        {"swiftwatcher": json.dumps(attributes)})
+
+    pq.write_table(table, str(save_directory/"{0}-swifts_results.parquet"
+                                             .format(count)))
+
+
+def aggregate_to_dict(df_counts):
+    """Convert an aggregate count dataframe into a compact dictionary
+    of integer microsecond times and count lists."""
+
+    origin = pd.Timestamp("00:00:00.000000")
+    microseconds = (df_counts.index - origin) // pd.Timedelta(1, unit="us")
+
+    return {"timestamp_us": [int(us) for us in microseconds],
+            "predicted": [int(n) for n in df_counts["predicted"]],
+            "rejected": [int(n) for n in df_counts["rejected"]]}
+
+
+def aggregate_from_dict(counts):
+    """Restore an aggregate count dataframe from aggregate_to_dict."""
+
+    return pd.DataFrame({"predicted": counts["predicted"],
+                         "rejected": counts["rejected"]},
+                        index=microseconds_to_timestamps(
+                            counts["timestamp_us"]))
+
+
+def results_from_parquet(filepath):
+    """Load a results file created by save_to_parquet. Returns the
+    event dataframe (indexed by timestamp and frame number, with list
+    columns for frame numbers and centroids), the per-second and
+    per-minute count dataframes, and a dictionary of video attributes
+    (fps, start, end, count)."""
+
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(str(filepath))
+    attributes = json.loads(table.schema.metadata[b"swiftwatcher"])
+
+    df_events = table.to_pandas()
+    df_events.set_index(["timestamp", "framenumber"], inplace=True)
+    df_seconds = aggregate_from_dict(attributes.pop("seconds"))
+    df_minutes = aggregate_from_dict(attributes.pop("minutes"))
+
+    return df_events, df_seconds, df_minutes, attributes
+
+
 ###############################################################################
 #               RESEARCH EXPERIMENTATION FUNCTIONS BEGIN HERE                 #
 ###############################################################################
@@ -0,0 +1,238 @@
+"""
+    Contains functionality for exporting segment images (e.g. to build a
+    training dataset for the segment classifier). Images are encoded and
+    written by background threads in batches, so that exporting overlaps
+    with segmentation and tracking rather than stalling them.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from pathlib import Path
+import csv
+
+import numpy as np
+import cv2
+
+import swiftwatcher.image_filtering as img
+import swiftwatcher.profiling as prof
+
+# Highlight drawn over a segment's bbox in overlay images (BGR)
+OVERLAY_COLOR = (0, 0, 255)
+OVERLAY_ALPHA = 0.6
+
+METADATA_COLUMNS = ["filename", "frame_number", "label",
+                    "area", "aspect", "intensity"]
+
+
+class SegmentExporter:
+    """Exports the segments of every submitted frame, in one of two
+    formats:
+
+        -"png": Each segment image is written to its own file, along
+         with an overlay image showing where the segment is within the
+         chimney crop. Shape features are appended to 'segments.csv', so
+         that sorted segments can be used to fit a prefilter.
+        -"hdf5": Segment images and their metadata (frame number, label,
+         bbox and shape features) are appended to chunked datasets in a
+         single 'segments.h5' file. Overlays aren't written, as they can
+         be reproduced from each segment's bbox.
+
+    Frames are grouped into batches of roughly batch_size segments (or
+    max_batch_frames frames), and each batch is written by a worker
+    thread (encoding and file I/O both release the GIL). At most
+    max_pending batches are queued at once, which bounds the memory held
+    by frames waiting to be written. Previously exported metadata is
+    replaced, unless appending (e.g. when resuming an interrupted run)."""
+
+    def __init__(self, export_dir, export_format="png", batch_size=256,
+                 max_batch_frames=32, n_workers=2, max_pending=4,
+                 append=False):
+        self.export_dir = Path(export_dir)
+        self.export_format = export_format
+        self.batch_size = batch_size
+        self.max_batch_frames = max_batch_frames
+        self.max_pending = max_pending
+
+        # Directories are only created once, rather than for each segment
+        Path.mkdir(self.export_dir, parents=True, exist_ok=True)
+        if export_format == "png":
+            Path.mkdir(self.export_dir / "overlay", exist_ok=True)
+            self.writer = PNGSegmentWriter(self.export_dir, append)
+        elif export_format == "hdf5":
+            # Appends to a single file must happen one batch at a time
+            n_workers = 1
+            self.writer = HDF5SegmentWriter(self.export_dir / "segments.h5",
+                                            append)
+        else:
+            raise ValueError("Unknown export format '{}'."
+                             .format(export_format))
+
+        self.executor = ThreadPoolExecutor(max_workers=n_workers)
+        self.pending = deque()
+        self.batch = []
+        self.n_batched = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def submit(self, frame):
+        """Queue a frame's segments to be exported. Frames hold their
+        images until written, so images aren't copied."""
+
+        if not frame.segments:
+            return
+
+        self.batch.append(frame)
+        self.n_batched += len(frame.segments)
+        if (self.n_batched >= self.batch_size or
+                len(self.batch) >= self.max_batch_frames):
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+
+        while len(self.pending) >= self.max_pending:
+            self.writer.write_metadata(self.pending.popleft().result())
+
+        self.pending.append(self.executor.submit(self.write_batch,
+                                                 self.batch, self.n_batched))
+        self.batch, self.n_batched = [], 0
+
+    def write_batch(self, frames, n_segments):
+        with prof.stage("export", frames=len(frames), segments=n_segments):
+            return self.writer.write_batch(frames)
+
+    def close(self):
+        """Write any remaining segments, then wait for every batch."""
+
+        self.flush()
+        while self.pending:
+            self.writer.write_metadata(self.pending.popleft().result())
+        self.executor.shutdown()
+        self.writer.close()
+
+
+class PNGSegmentWriter:
+    """Writes segment and overlay images as individual PNG files.
+    Metadata rows are returned by write_batch (in a worker thread), then
+    written in submission order by write_metadata (in the main thread)."""
+
+    def __init__(self, export_dir, append=False):
+        self.export_dir = export_dir
+
+        metadata_path = export_dir / "segments.csv"
+        write_header = not (append and metadata_path.exists())
+        self.metadata_file = open(str(metadata_path), "a" if append else "w",
+                                  newline="")
+        self.metadata = csv.writer(self.metadata_file)
+        if write_header:
+            self.metadata.writerow(METADATA_COLUMNS)
+
+    def write_batch(self, frames):
+        rows = []
+        for frame in frames:
+            filenames = ['"{}"_{}_{}_{}.png'.format(frame.src_video,
+                                                    frame.frame_number,
+                                                    segment.label,
+                                                    len(frame.segments))
+                         for segment in frame.segments]
+            features = img.get_segment_features(frame.segments)
+
+            for overlay, filename in zip(generate_overlays(frame), filenames):
+                cv2.imwrite(str(self.export_dir / "overlay" / filename),
+                            overlay)
+
+            for segment, filename, segment_features \
+                    in zip(frame.segments, filenames, features):
+                cv2.imwrite(str(self.export_dir / filename),
+                            segment.segment_image)
+                rows.append([filename, frame.frame_number, segment.label,
+                             *segment_features])
+
+        return rows
+
+    def write_metadata(self, rows):
+        self.metadata.writerows(rows)
+
+    def close(self):
+        self.metadata_file.close()
+
+
+class HDF5SegmentWriter:
+    """Appends segment images and metadata to resizable, chunked
+    datasets in a single HDF5 file. Segment images vary in size, so each
+    is stored flattened, alongside its shape."""
+
+    def __init__(self, filepath, append=False):
+        # Only imported when needed, as h5py is slow to import
+        import h5py
+
+        self.h5_file = h5py.File(str(filepath), "a" if append else "w")
+        self.datasets = {}
+        self.create_dataset("image", (), h5py.special_dtype(vlen=np.uint8))
+        self.create_dataset("shape", (3,), np.int64)
+        self.create_dataset("frame_number", (), np.int64)
+        self.create_dataset("label", (), np.int64)
+        self.create_dataset("bbox", (4,), np.int64)
+        self.create_dataset("features", (3,), np.float64)
+        self.datasets["features"].attrs["columns"] = METADATA_COLUMNS[3:]
+
+    def create_dataset(self, name, shape, dtype):
+        if name in self.h5_file:
+            self.datasets[name] = self.h5_file[name]
+        else:
+            self.datasets[name] = self.h5_file.create_dataset(
+                name, shape=(0,) + shape, maxshape=(None,) + shape,
+                dtype=dtype, chunks=(1024,) + shape, compression="lzf")
+
+    def append(self, name, values):
+        dataset = self.datasets[name]
+        n = dataset.shape[0]
+        dataset.resize(n + len(values), axis=0)
+        dataset[n:] = values
+
+    def write_batch(self, frames):
+        segments = [segment for frame in frames for segment in frame.segments]
+        images = [np.ascontiguousarray(segment.segment_image)
+                  for segment in segments]
+
+        flattened = np.empty(len(images), dtype=object)
+        for i, image in enumerate(images):
+            flattened[i] = image.ravel()
+        self.h5_file.attrs["src_video"] = frames[0].src_video
+        self.append("image", flattened)
+        self.append("shape", [image.shape for image in images])
+        self.append("frame_number", [frame.frame_number for frame in frames
+                                     for _ in frame.segments])
+        self.append("label", [segment.label for segment in segments])
+        self.append("bbox", [segment.bbox for segment in segments])
+        self.append("features", img.get_segment_features(segments))
+
+    def write_metadata(self, rows):
+        pass  # Metadata is written alongside images
+
+    def close(self):
+        self.h5_file.close()
+
+
+def generate_overlays(frame):
+    """Yield one image per segment, highlighting that segment's bbox
+    within the chimney crop. The crop is copied once per frame: each
+    segment's region is blended, yielded, then restored."""
+
+    crop = frame.processed_frames["crop"]
+    overlay = crop.copy()
+
+    for segment in frame.segments:
+        # Bbox is [H1, W1, H2, W2]. Highlight includes the (H2, W2) edges.
+        y1, x1, y2, x2 = segment.bbox
+        region = crop[y1:y2 + 1, x1:x2 + 1]
+        highlight = np.empty_like(region)
+        highlight[:] = OVERLAY_COLOR
+        overlay[y1:y2 + 1, x1:x2 + 1] = cv2.addWeighted(
+            highlight, OVERLAY_ALPHA, region, 1 - OVERLAY_ALPHA, 0)
+
+        yield overlay
+
+        overlay[y1:y2 + 1, x1:x2 + 1] = region
@@ -5,7 +5,6 @@
 import pandas as pd
 import numpy as np
 import cv2
-import h5py
 
 
 class FrameReader:
@@ -58,6 +57,12 @@ class FrameReader:
 
         return frame, frame_number, timestamp
 
+    def seek(self, frame_number):
+        """Set the frame number that will be returned by the next call
+        to get_frame()."""
+
+        self.next_frame_number = frame_number
+
     def get_n_frames(self, n):
         """Calls get_frame in batches of N, returning as lists."""
 
@@ -88,6 +93,9 @@ class HDF5Reader(FrameReader):
     def __init__(self, filepath, start=0, end=0):
         super().__init__()
 
+        # Only imported when needed, as h5py is slow to import
+        import h5py
+
         # Set file object using filepath for reading frames
         self.filepath = filepath
         self.hdf5_file = h5py.File(str(filepath), "r")
@@ -134,7 +142,7 @@ class HDF5Reader(FrameReader):
 class VideoReader(FrameReader):
     """Subclass using OpenCV's VideoCapture as frame source."""
 
-    def __init__(self, filepath, end):
+    def __init__(self, filepath, end, start=0):
         super().__init__()
 
         # Set file object using filepath for reading frames
@@ -143,7 +151,7 @@ class VideoReader(FrameReader):
         self.vid_cap.grab()  # Load first frame so retrieve() won't fail
 
         self.fps = self.vid_cap.get(cv2.CAP_PROP_FPS)
-        self.start_frame = 0
+        self.start_frame = start
         if end > 0:
             self.end_frame = end
         else:
@@ -151,6 +159,17 @@ class VideoReader(FrameReader):
 
         self.next_frame_number = self.start_frame
         self.total_frames = self.end_frame - self.start_frame
+        if self.start_frame > 0:
+            self.seek(self.start_frame)
+
+    def seek(self, frame_number):
+        """Move the underlying capture to a frame number. (Seeking
+        relies on the video's index, so it may be less precise than
+        reading sequentially for some codecs.)"""
+
+        super().seek(frame_number)
+        self.vid_cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+        self.vid_cap.grab()  # Load frame so retrieve() won't fail
 
     def read_frame(self, frame_number, increment=True):
         """Read frame from video file, fulfills constraint from base
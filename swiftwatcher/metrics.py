@@ -0,0 +1,216 @@
+"""
+    Contains functionality for publishing live metrics from a running
+    analysis (throughput, queue depths, events detected so far, ETA,
+    memory usage) in the OpenMetrics text format. Metrics can be served
+    over HTTP for a scraper, or written periodically to a file (e.g. on
+    a shared filesystem, for hosts which can't be scraped). Per-stage
+    throughput is taken from the profiler, so the profiler must be
+    enabled.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import deque
+from pathlib import Path
+import threading
+import time
+import os
+
+import swiftwatcher.profiling as prof
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+class LiveMetrics:
+    """Holds the latest state of the video being processed. State is
+    updated by the main thread once per queue of frames, and rendered
+    on demand by the publishing thread."""
+
+    def __init__(self, window=30):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.window = window
+        self.video = None
+        self.reset()
+
+    def reset(self, video=None, total_frames=0):
+        with self.lock:
+            self.video = video
+            self.total_frames = total_frames
+            self.frames_processed = 0
+            self.segments = 0
+            self.events = 0
+            self.queue_depths = {}
+            self.start_time = time.time()
+            self.last_update = self.start_time
+
+            # Recent (time, frames processed), to estimate current speed
+            self.history = deque([(self.start_time, 0)], maxlen=self.window)
+
+    def update(self, frames_processed, segments, events, queue_depths):
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.last_update = time.time()
+            self.frames_processed = frames_processed
+            self.segments += segments
+            self.events = events
+            self.queue_depths = queue_depths
+            self.history.append((self.last_update, frames_processed))
+
+    def render(self):
+        """Render every metric in the OpenMetrics text format."""
+
+        with self.lock:
+            (t0, f0), (t1, f1) = self.history[0], self.history[-1]
+            fps = (f1 - f0) / (t1 - t0) if t1 > t0 else 0.0
+            remaining = self.total_frames - self.frames_processed
+            eta = remaining / fps if fps > 0 else float("nan")
+            segments_per_frame = self.segments / max(self.frames_processed, 1)
+            labels = {"video": self.video or ""}
+
+            lines = []
+            add_metric(lines, "video", "info", "Video being processed",
+                       [(labels, 1)])
+            add_metric(lines, "frames_processed", "counter",
+                       "Frames segmented so far",
+                       [(labels, self.frames_processed)])
+            add_metric(lines, "frames", "gauge", "Frames in the video",
+                       [(labels, self.total_frames)])
+            add_metric(lines, "frames_per_second", "gauge",
+                       "Recent overall throughput", [(labels, fps)])
+            add_metric(lines, "eta_seconds", "gauge",
+                       "Estimated time until the video is processed",
+                       [(labels, eta)])
+            add_metric(lines, "segments_per_frame", "gauge",
+                       "Mean segments found per frame",
+                       [(labels, segments_per_frame)])
+            add_metric(lines, "events", "counter",
+                       "Events (potential swifts) detected so far",
+                       [(labels, self.events)])
+            add_metric(lines, "queue_depth", "gauge",
+                       "Batches waiting in each background queue",
+                       [(dict(labels, queue=name), depth)
+                        for name, depth in sorted(self.queue_depths.items())])
+            add_metric(lines, "last_update_timestamp_seconds", "gauge",
+                       "Time of the last progress update (to find stalls)",
+                       [(labels, self.last_update)])
+
+        stages = prof.profiler.report()
+        add_metric(lines, "stage_frames_per_second", "gauge",
+                   "Throughput of each stage while running",
+                   [(dict(labels, stage=stage["stage"]),
+                     stage["frames"] / stage["seconds"])
+                    for stage in stages
+                    if stage["frames"] and stage["seconds"]])
+        add_metric(lines, "stage_seconds", "counter",
+                   "Time spent in each stage",
+                   [(dict(labels, stage=stage["stage"]), stage["seconds"])
+                    for stage in stages])
+        add_metric(lines, "resident_memory_bytes", "gauge",
+                   "Resident set size of the process",
+                   [(labels, prof.get_rss_bytes())])
+        lines.append("# EOF")
+
+        return "\n".join(lines) + "\n"
+
+
+def add_metric(lines, name, metric_type, description, samples):
+    """Append a metric family (with one line per labelled sample)."""
+
+    name = "swiftwatcher_" + name
+    lines.append("# TYPE {} {}".format(name, metric_type))
+    lines.append("# HELP {} {}".format(name, description))
+
+    # Counter samples need a "_total" suffix, info samples an "_info" suffix
+    suffix = {"counter": "_total", "info": "_info"}.get(metric_type, "")
+    for labels, value in samples:
+        label_str = ",".join('{}="{}"'.format(key, escape(label))
+                             for key, label in labels.items())
+        lines.append("{}{}{{{}}} {}".format(name, suffix, label_str,
+                                            format_value(value)))
+
+
+def escape(value):
+    return (str(value).replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+
+def format_value(value):
+    if value != value:
+        return "NaN"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+###############################################################################
+#                         METRICS PUBLISHING BEGINS HERE                      #
+###############################################################################
+
+
+def start(port=None, filepath=None, interval=10):
+    """Start publishing metrics from this process (once only, as worker
+    processes each publish their own metrics)."""
+
+    global started_pid
+    if started_pid == os.getpid():
+        return
+
+    started_pid = os.getpid()
+    metrics.enabled = True
+    if port is not None:
+        serve_http(port)
+    if filepath is not None:
+        write_periodically(filepath, interval)
+
+
+def serve_http(port, host="127.0.0.1"):
+    """Serve metrics at http://<host>:<port>/metrics from a background
+    thread. Returns the server, or None if the port is unavailable
+    (e.g. when several processes are started with the same port)."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes shouldn't interrupt status output
+
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        print("[!] Unable to serve metrics on port {}: {}".format(port, e))
+        return None
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def write_periodically(filepath, interval=10):
+    """Atomically rewrite a metrics file every interval seconds from a
+    background thread. '{pid}' in the filepath is replaced with the
+    process ID, so that concurrent workers write separate files."""
+
+    filepath = Path(str(filepath).format(pid=os.getpid()))
+    if not filepath.parent.exists():
+        Path.mkdir(filepath.parent, parents=True)
+
+    def write():
+        while True:
+            tmp_filepath = filepath.with_suffix(".tmp")
+            with open(str(tmp_filepath), "w") as f:
+                f.write(metrics.render())
+            os.replace(str(tmp_filepath), str(filepath))
+            time.sleep(interval)
+
+    threading.Thread(target=write, daemon=True).start()
+
+
+# Shared metrics, updated by the algorithm while a video is processed
+metrics = LiveMetrics()
+started_pid = None
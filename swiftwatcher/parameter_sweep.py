@@ -0,0 +1,120 @@
+"""
+    Contains functionality to tune tracking and event classification
+    parameters. Rather than reprocessing videos for every candidate
+    value, tracking and classification are replayed from cached
+    segmentation output (see io_cache) in parallel processes, and each
+    configuration is scored against ground truth counts.
+"""
+
+from itertools import product
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+import swiftwatcher.io_data as dio
+import swiftwatcher.io_cache as ioc
+import swiftwatcher.segment_tracking as st
+import swiftwatcher.event_classification as ec
+
+
+def run_sweep(videos, tracking_grid, windows, processes=None):
+    """Evaluate every combination of tracking parameters and event
+    classification windows on a list of videos.
+
+    videos:        List of (name, segment cache path, ground truth
+                   dataframe) tuples.
+    tracking_grid: Dictionary mapping tracking parameter names (see
+                   st.TRACKING_PARAMS) to lists of candidate values.
+    windows:       List of candidate angle windows (in degrees) around
+                   the mode used by ec.generate_classifications.
+
+    Returns a dataframe with one row per configuration, sorted from
+    best to worst total absolute count error across all videos."""
+
+    names = sorted(tracking_grid.keys())
+    tracking_configs = [dict(zip(names, values)) for values
+                        in product(*[tracking_grid[n] for n in names])]
+
+    # Tracking is the expensive part, so each job replays tracking once
+    # and then evaluates every classification window on the same events
+    jobs = [(video, tracking_params, windows)
+            for video in videos for tracking_params in tracking_configs]
+
+    with Pool(processes) as pool:
+        results = pool.map(evaluate_configuration, jobs)
+
+    df_results = pd.DataFrame([row for rows in results for row in rows])
+    df_summary = df_results.groupby(names + ["window"]).agg(
+        total_abs_error=("abs_error", "sum"),
+        minute_mae=("minute_mae", "mean"),
+        predicted=("predicted", "sum"),
+        groundtruth=("groundtruth", "sum"),
+    ).reset_index()
+
+    return df_summary.sort_values(["total_abs_error", "minute_mae"]), \
+        df_results
+
+
+def evaluate_configuration(job):
+    """Replay tracking with one set of tracking parameters, then score
+    event classification for each window against the ground truth."""
+
+    (name, cache_path, df_groundtruth), tracking_params, windows = job
+
+    # Only tracking is replayed, so segment patches are never needed
+    cache = ioc.SegmentCacheReader(cache_path, load_patches=False)
+    events = replay_tracking(cache, tracking_params)
+    gt_minutes = count_groundtruth_per_minute(df_groundtruth, cache.fps)
+
+    rows = []
+    for window in windows:
+        if events:
+            df_features = ec.generate_angle_features_from_arrays(
+                ec.convert_events_to_arrays(events))
+            df_labels = ec.classify_features(df_features, window)
+            predicted = df_labels[df_labels["label"] > 0]
+            frames = predicted.index.get_level_values("framenumber").values
+        else:
+            frames = np.array([], dtype=np.int64)
+
+        minutes = dio.frames_to_microseconds(frames, cache.fps) // int(60e6)
+        n_bins = max(len(gt_minutes), int(np.max(minutes, initial=-1)) + 1)
+        pred_minutes = np.bincount(minutes, minlength=n_bins)
+        gt_padded = np.pad(gt_minutes, (0, n_bins - len(gt_minutes)))
+
+        rows.append(dict(tracking_params, video=name, window=window,
+                         predicted=len(frames),
+                         groundtruth=int(np.sum(gt_minutes)),
+                         abs_error=abs(len(frames) - int(np.sum(gt_minutes))),
+                         minute_mae=float(np.mean(np.abs(pred_minutes -
+                                                         gt_padded)))))
+
+    return rows
+
+
+def replay_tracking(cache, tracking_params):
+    """Track segments through every cached frame, returning the list
+    of detected events."""
+
+    tracker = st.SegmentTracker(cache.roi_mask, tracking_params)
+    for frame in cache.iter_frames():
+        tracker.track_frame(frame)
+
+    return tracker.detected_events
+
+
+def count_groundtruth_per_minute(df_groundtruth, fps, column=None):
+    """Bin ground truth counts (indexed by timestamp and frame number,
+    as loaded by dio.dataframe_from_csv) into per-minute counts. If no
+    column is specified, the first column is used as the count."""
+
+    if column is None:
+        column = df_groundtruth.columns[0]
+
+    frames = df_groundtruth.index.get_level_values("framenumber").values
+    minutes = dio.frames_to_microseconds(frames, fps) // int(60e6)
+
+    return np.bincount(minutes,
+                       weights=df_groundtruth[column].fillna(0).values
+                       ).astype(np.int64)
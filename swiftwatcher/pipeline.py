@@ -0,0 +1,248 @@
+"""
+    Contains functionality for segmenting a single video using several
+    processes at once. Frames are decoded by the main process and placed
+    into a ring of shared memory slots (one queue of frames per slot),
+    rather than being pickled. Worker processes each segment an entire
+    queue at a time (preprocessing, RPCA, post-filtering and labeling),
+    and return only the resulting segments. Queues are processed
+    independently, so several can be segmented at once, then reordered
+    by the main process before classification and tracking.
+"""
+
+from multiprocessing import shared_memory
+import multiprocessing
+import queue
+import time
+
+import numpy as np
+
+import swiftwatcher.data_structures as ds
+import swiftwatcher.profiling as prof
+import swiftwatcher.thread_budget as tb
+import swiftwatcher.ui as ui
+
+
+class FrameRing:
+    """Fixed number of shared memory slots, each large enough to hold a
+    queue of frames. Slots are reused once their queue is segmented."""
+
+    def __init__(self, n_slots, max_frames, frame_shape, name=None):
+        self.shape = (n_slots, max_frames) + tuple(frame_shape)
+        size = int(np.prod(self.shape))
+
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.array = np.ndarray(self.shape, dtype=np.uint8,
+                                buffer=self.shm.buf)
+
+    @classmethod
+    def attach(cls, attributes):
+        """Attach to a ring created by another process."""
+
+        n_slots, max_frames, frame_shape, name = attributes
+        return cls(n_slots, max_frames, frame_shape, name)
+
+    def get_attributes(self):
+        return self.shape[0], self.shape[1], self.shape[2:], self.shm.name
+
+    def write(self, slot, frames):
+        for i, frame in enumerate(frames):
+            self.array[slot, i] = frame
+
+    def read(self, slot, n_frames):
+        """Return views (not copies) of the frames stored in a slot."""
+
+        return list(self.array[slot, :n_frames])
+
+    def close(self, unlink=False):
+        del self.array  # Buffer can't be closed while views exist
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class ParallelSegmenter:
+    """Segments queues of frames using a pool of worker processes. Each
+    worker is sent (batch index, slot, frame numbers, timestamps) and
+    returns (batch index, slot, segmented frames). At most one queue per
+    slot is in flight, and callers should keep no more queues than there
+    are slots between submitting and consuming them (see n_slots), so
+    that the ring also bounds memory usage. Each worker is limited to
+    n_threads threads."""
+
+    def __init__(self, n_workers, frame_shape, max_frames, crop_region,
+                 resize_dim, export=False, n_threads=1):
+        context = multiprocessing.get_context("spawn")
+        self.n_slots = 2 * n_workers
+        self.ring = FrameRing(self.n_slots, max_frames, frame_shape)
+        self.free_slots = list(range(self.n_slots))
+        self.workers = []
+
+        # Shared memory outlives this process unless it is unlinked, so
+        # it must be released if workers can't be started (e.g. if this
+        # is a daemonic process, which can't have children)
+        try:
+            self.tasks = context.Queue()
+            self.results = context.Queue()
+
+            worker_args = (self.ring.get_attributes(), crop_region,
+                           resize_dim, export, prof.profiler.enabled,
+                           n_threads, self.tasks, self.results)
+            with tb.child_environment(n_threads):
+                for _ in range(n_workers):
+                    worker = context.Process(target=segment_worker,
+                                             args=worker_args, daemon=True)
+                    worker.start()
+                    self.workers.append(worker)
+        except BaseException:
+            for worker in self.workers:
+                worker.terminate()
+            self.ring.close(unlink=True)
+            raise
+
+    def has_free_slot(self):
+        return len(self.free_slots) > 0
+
+    def submit(self, batch_index, frames, frame_numbers, timestamps):
+        slot = self.free_slots.pop()
+        self.ring.write(slot, frames)
+        self.tasks.put((batch_index, slot, frame_numbers, timestamps))
+
+    def get_result(self):
+        """Wait for any queue to be segmented, freeing its slot."""
+
+        while True:
+            try:
+                batch_index, slot, frames, profile = \
+                    self.results.get(timeout=1)
+                break
+            except queue.Empty:
+                # Otherwise, a killed worker (e.g. out of memory) would
+                # leave the main process waiting forever
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError("A segmentation worker process "
+                                       "exited unexpectedly.")
+
+        if isinstance(frames, Exception):
+            raise frames
+
+        self.free_slots.append(slot)
+        prof.profiler.merge(*profile)
+
+        return batch_index, frames
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self.ring.close(unlink=True)
+
+
+def segment_worker(ring_attributes, crop_region, resize_dim, export,
+                   profile, n_threads, tasks, results):
+    """Segment queues of frames read from the ring until told to stop.
+    Runs in a worker process. (The ring is closed and unlinked by the
+    main process only.)"""
+
+    ring = FrameRing.attach(ring_attributes)
+    prof.profiler.enabled = profile
+    tb.configure(n_threads)
+
+    for task in iter(tasks.get, None):
+        batch_index, slot, frame_numbers, timestamps = task
+        prof.profiler.reset()
+        try:
+            frame_queue = ds.FrameQueue(len(frame_numbers))
+            frame_queue.push_list_of_frames(
+                ring.read(slot, len(frame_numbers)), frame_numbers,
+                timestamps)
+            frame_queue.preprocess_queue(crop_region, resize_dim)
+            frame_queue.segment_queue((24, 24), crop_region)
+            frames = [strip_frame(frame, export)
+                      for frame in frame_queue.pop_all_frames()]
+        except Exception as e:
+            frames = e
+
+        results.put((batch_index, slot, frames,
+                     (prof.profiler.report(), prof.profiler.counters)))
+
+
+def strip_frame(frame, export):
+    """Remove images which aren't needed after segmentation, so that as
+    little data as possible is returned to the main process. Segment
+    images are views of the shared frame, so they're copied."""
+
+    stripped = ds.Frame(None, frame.frame_number, frame.timestamp)
+    if export:
+        stripped.processed_frames["crop"] = frame.processed_frames["crop"]
+    for segment in frame.segments:
+        segment.segment_image = np.array(segment.segment_image)
+    stripped.segments = frame.segments
+
+    return stripped
+
+
+def segment_frames_parallel(reader, crop_region, resize_dim, frame_shape,
+                            n_workers, queue_size=21, segment_cache=None,
+                            export=False, n_threads=1):
+    """Parallel alternative to segment_frames in processing.py, yielding
+    each queue's list of segmented frames (in frame order)."""
+
+    segmenter = ParallelSegmenter(n_workers, frame_shape,
+                                  queue_size + ds.MIN_QUEUE_SIZE - 1,
+                                  crop_region, resize_dim, export, n_threads)
+
+    frames_read = reader.next_frame_number - reader.start_frame
+    frames_processed = frames_read
+    next_submit, next_yield, completed = 0, 0, {}
+
+    try:
+        while frames_processed < reader.total_frames:
+            # Keep every slot busy while frames remain to be decoded. A
+            # slot is freed as soon as its queue is segmented, so queues
+            # waiting to be yielded in order are counted against the ring
+            # as well, or one slow queue would let them pile up.
+            while (segmenter.has_free_slot() and
+                   next_submit - next_yield < segmenter.n_slots and
+                   frames_read < reader.total_frames):
+                n = ds.get_batch_size(queue_size,
+                                      reader.total_frames - frames_read)
+                with prof.stage("decode", frames=n):
+                    frames, frame_numbers, timestamps = \
+                        reader.get_n_frames(n=n)
+                segmenter.submit(next_submit, frames, frame_numbers,
+                                 timestamps)
+                frames_read += n
+                next_submit += 1
+
+            # Results may arrive out of order, but are yielded in order
+            start = time.perf_counter()
+            batch_index, segmented_frames = segmenter.get_result()
+            prof.record("wait_for_workers", time.perf_counter() - start)
+            completed[batch_index] = segmented_frames
+
+            while next_yield in completed:
+                segmented_frames = completed.pop(next_yield)
+                next_yield += 1
+                frames_processed += len(segmented_frames)
+                if segment_cache is not None:
+                    segment_cache.write_frames(segmented_frames)
+
+                yield segmented_frames
+
+                ui.frames_processed_status(frames_processed,
+                                           reader.total_frames)
+    except BaseException:
+        if segment_cache is not None:
+            segment_cache.discard()
+        raise
+    finally:
+        segmenter.close()
+
+    if segment_cache is not None:
+        segment_cache.close()
@@ -0,0 +1,429 @@
+"""
+    Contains functionality for counting swifts in a single video: the
+    stages of the swift counting algorithm (segmentation, optional
+    classification, tracking and event classification), along with
+    exporting and caching of its results.
+"""
+
+import swiftwatcher.ui as ui
+import swiftwatcher.io_video as vio
+import swiftwatcher.io_data as dio
+import swiftwatcher.data_structures as ds
+import swiftwatcher.image_filtering as img
+import swiftwatcher.segment_tracking as st
+import swiftwatcher.event_classification as ec
+import swiftwatcher.io_cache as ioc
+import swiftwatcher.io_export as ioe
+import swiftwatcher.profiling as prof
+import swiftwatcher.metrics as mt
+import swiftwatcher.pipeline as pl
+import swiftwatcher.thread_budget as tb
+
+import multiprocessing
+from pathlib import Path
+import copy
+import time
+
+import numpy as np
+
+
+def process_video(src_filepath, corners, args, output_subdir=None,
+                  save_features=False):
+    """Count swifts in a single video, exporting the results to a
+    directory next to the video (or a subdirectory of it, e.g. for one
+    shard of a video). Returns the number of detected events. If corners
+    aren't provided, they are loaded from the video's attributes.json
+    file, or selected using a GUI (unless headless). If save_features is
+    True, unclassified event features are saved as well, so that shards
+    of a video can later be classified together."""
+
+    # Daemonic processes (e.g. multiprocessing.Pool workers) can't start
+    # worker processes of their own
+    if args.workers > 0 and multiprocessing.current_process().daemon:
+        print("[!] --workers is ignored in a daemonic process; segmenting "
+              "in the job's own process instead.")
+        args = copy.copy(args)
+        args.workers = 0
+
+    # 1. Load frame source into FrameReader object
+    reader = open_reader(src_filepath, args)
+
+    # 2. Specify in-frame corner coordinates
+    output_dir = src_filepath.parent / src_filepath.stem
+    if corners is None:
+        if (output_dir / "attributes.json").is_file():
+            corners = ui.get_corners_from_file(output_dir / "attributes.json")
+        elif args.headless:
+            raise RuntimeError("No corners specified for '{}', and corners "
+                               "can't be selected in headless mode."
+                               .format(src_filepath.name))
+        else:
+            corners = ui.select_chimney_corners(src_filepath)
+    if output_subdir is not None:
+        output_dir = output_dir / output_subdir
+
+    # Checkpoints and exports are kept outside of debug directories, so
+    # that an interrupted run can still be resumed
+    work_dir = output_dir
+    if args.debug:
+        output_dir = dio.generate_test_dir(output_dir)
+    Path.mkdir(output_dir, parents=True, exist_ok=True)
+
+    # Skip videos which have already been processed with the same inputs
+    # (unless outputs which aren't cached are requested, e.g. --export)
+    result_cache, key = None, None
+    if args.result_cache is not None:
+        result_cache = load_result_cache(args)
+        key = ioc.result_cache_key(src_filepath, corners, reader.start_frame,
+                                   reader.end_frame, args)
+        side_outputs = [name for name in ioc.UNCACHED_OPTIONS
+                        if getattr(args, name)]
+        restored = None
+        if side_outputs:
+            print("[!] Not restoring cached results for {}, as --{} "
+                  "output isn't cached.".format(
+                      src_filepath.name, side_outputs[0].replace("_", "-")))
+        elif save_features:
+            print("[!] Not restoring cached results for {}, as shard "
+                  "features aren't cached.".format(src_filepath.name))
+        else:
+            restored = result_cache.get(key, output_dir)
+        if restored is not None:
+            print("[*] Skipping {}, restored {} cached result files."
+                  .format(src_filepath.name, len(restored)))
+            return None
+
+    # 3. Detect motion which could indicate swifts entering the chimney
+    ui.start_status(src_filepath.name)
+    tb.configure(tb.get_budget(args))
+    publish_metrics = (args.metrics_port is not None or
+                       args.metrics_file is not None)
+    if publish_metrics:
+        mt.start(args.metrics_port, args.metrics_file, args.metrics_interval)
+        mt.metrics.reset(src_filepath.name, reader.total_frames)
+    prof.profiler.enabled = args.profile or args.memory or publish_metrics
+    prof.profiler.reset()
+    if args.memory:
+        prof.memory_monitor.start([ds.Frame, ds.Segment])
+    events = swift_counting_algorithm(reader, corners, args, work_dir)
+    if args.memory:
+        prof.memory_monitor.stop()
+        prof.memory_monitor.save(output_dir)
+    if args.profile or args.memory:
+        prof.profiler.save(output_dir, src_filepath.name, extra={
+            "threads": tb.get_settings(args.workers)})
+
+    # 4. If relevant motion was detected, classify instances and export
+    event_arrays = ec.convert_events_to_arrays(events)
+    df_features = ec.generate_angle_features_from_arrays(event_arrays)
+    if save_features:
+        dio.save_shard_features(work_dir, df_features)
+
+    result_filepaths = []
+    if events:
+        df_labels = ec.classify_features(df_features)
+
+        total = dio.export_results(output_dir, df_labels, reader.fps,
+                                   reader.start_frame, reader.end_frame,
+                                   args.full_usec,
+                                   event_arrays if args.parquet else None)
+        result_filepaths = dio.get_result_filepaths(output_dir, total,
+                                                    args.full_usec,
+                                                    args.parquet)
+    else:
+        print("[!] No events detected in video '{}'."
+              .format(src_filepath.stem))
+
+    if result_cache is not None:
+        result_cache.put(key, result_filepaths, src_filepath.name)
+
+    return len(events)
+
+
+def open_reader(src_filepath, args):
+    """Load a frame source into a FrameReader object."""
+
+    if src_filepath.suffix in ['.h5', '.hdf5']:
+        return vio.HDF5Reader(src_filepath, args.start, args.end)
+    else:
+        return vio.VideoReader(src_filepath, args.end, args.start)
+
+
+def swift_counting_algorithm(reader, corners, args, output_dir=None):
+    """Apply individual stages of the multi-stage swift counting
+    algorithm to detect potential occurrences of swifts entering
+    chimneys. Checkpoints, exported segments and provisional counts are
+    written to output_dir (by default, the directory next to the video),
+    which must be unique to the job when jobs share a video."""
+
+    # Use first frame and coordinates to get regions of interest
+    ff = reader.read_frame(0, increment=False)
+    crop_region, roi_mask, resize_dim = img.generate_regions(ff, corners)
+    ds.Frame.src_video = reader.filepath.stem
+
+    video_dir = reader.filepath.parent / reader.filepath.stem
+    if output_dir is None:
+        output_dir = video_dir
+    key = ioc.segment_cache_key(reader.filepath, corners,
+                                reader.start_frame, reader.end_frame,
+                                ioc.get_queue_size_key(args))
+
+    # Replay previously cached segments instead of segmenting, if possible
+    # (the cache is shared by every job of a video, as it's keyed on range)
+    cache_path = ioc.get_segment_cache_path(video_dir, key)
+    if args.cache_segments and cache_path.is_file():
+        print("[-]     Replaying cached segments from {}."
+              .format(cache_path.name))
+        cache = ioc.SegmentCacheReader(cache_path)
+        return track_frame_batches(cache.iter_frame_batches(),
+                                   cache.roi_mask, reader, args, output_dir,
+                                   replay=True)
+
+    # Continue from the last checkpoint of an interrupted run, if requested
+    checkpoint_key = ioc.hash_parameters([key, st.TRACKING_PARAMS,
+                                          ioc.get_result_options(args)])
+    checkpointer = ioc.Checkpointer(output_dir / "checkpoint.pkl",
+                                    checkpoint_key, args.checkpoint_interval)
+    state = checkpointer.load() if args.resume else None
+    if state is not None:
+        print("[-]     Resuming from frame {}."
+              .format(state["next_frame_number"]))
+        reader.seek(state["next_frame_number"])
+
+    # Segment cache would be incomplete if only part of video is segmented
+    segment_cache = None
+    if args.cache_segments and state is None:
+        segment_cache = ioc.SegmentCacheWriter(cache_path, roi_mask,
+                                               crop_region, reader.fps)
+
+    if args.workers > 0:
+        # Queue size can't be tuned while several queues are in flight
+        if args.adaptive_queue:
+            print("[!] --adaptive-queue is ignored when using --workers.")
+        frame_batches = pl.segment_frames_parallel(
+            reader, crop_region, resize_dim, ff.shape, args.workers,
+            args.queue_size, segment_cache, args.export,
+            tb.get_worker_budget(tb.get_budget(args), args.workers))
+    else:
+        tuner = ds.QueueSizeTuner(args.queue_size) \
+            if args.adaptive_queue else None
+        frame_batches = segment_frames(reader, crop_region, resize_dim,
+                                       segment_cache, args.queue_size, tuner)
+    try:
+        events = track_frame_batches(frame_batches, roi_mask, reader, args,
+                                     output_dir, state=state,
+                                     checkpointer=checkpointer)
+    except BaseException:
+        # Segmentation may not have started (e.g. the classifier failed)
+        if segment_cache is not None:
+            segment_cache.discard()
+        raise
+    checkpointer.remove()
+
+    return events
+
+
+def segment_frames(reader, crop_region, resize_dim, segment_cache=None,
+                   queue_size=21, tuner=None):
+    """Read and segment frames an entire queue at a time, yielding each
+    queue's list of segmented frames (in frame order). If a segment
+    cache is provided, segments are written to it as well. If a tuner
+    is provided, it chooses the size of each queue instead."""
+
+    frames_processed = reader.next_frame_number - reader.start_frame
+
+    # An incomplete cache is removed if segmentation fails or is stopped
+    try:
+        while frames_processed < reader.total_frames:
+            if tuner is not None:
+                queue_size = tuner.next_size()
+            n = ds.get_batch_size(queue_size,
+                                  reader.total_frames - frames_processed)
+            queue = ds.FrameQueue(n)
+
+            # Push frames into queue until full
+            with prof.stage("decode", frames=n):
+                frames, frame_numbers, timestamps = reader.get_n_frames(n=n)
+                queue.push_list_of_frames(frames, frame_numbers, timestamps)
+
+            # Process an entire queue at once (CPU processing bottleneck)
+            start = time.perf_counter()
+            queue.preprocess_queue(crop_region, resize_dim)
+            queue.segment_queue((24, 24), crop_region)
+
+            segmented_frames = queue.pop_all_frames()
+            frames_processed += queue.frames_processed
+            if tuner is not None:
+                n_segments = sum(frame.get_num_segments()
+                                 for frame in segmented_frames)
+                if tuner.update(queue_size, time.perf_counter() - start, n,
+                                n_segments):
+                    ui.queue_size_status(tuner.best_size,
+                                         tuner.get_cost(tuner.best_size))
+            if segment_cache is not None:
+                segment_cache.write_frames(segmented_frames)
+
+            yield segmented_frames
+
+            ui.frames_processed_status(frames_processed, reader.total_frames)
+    except BaseException:
+        if segment_cache is not None:
+            segment_cache.discard()
+        raise
+
+    if segment_cache is not None:
+        segment_cache.close()
+
+
+def track_frame_batches(frame_batches, roi_mask, reader, args, output_dir,
+                        replay=False, state=None, checkpointer=None):
+    """Classify (optionally) and track segments through batches of
+    segmented frames, returning any detected events. Tracking can be
+    restored from a checkpoint's state, and periodically checkpointed.
+    Exported segments and provisional counts are saved to output_dir."""
+
+    # Initialize data structures needed for tracking/classification
+    tracker = st.SegmentTracker(roi_mask)
+    if state is not None:
+        tracker.cached_frame = state["cached_frame"]
+        tracker.detected_events = state["detected_events"]
+    if args.classify:
+        # Only imported when needed, as torch is slow to import
+        import swiftwatcher.segment_classification as sc
+        classifier = sc.SegmentClassifier(sc.MODEL_PATH, args.batch_size,
+                                          load_prefilter(args), args.quantized)
+        worker = sc.ClassifierWorker(classifier)
+    if args.live:
+        live = LiveCounter(reader, output_dir)
+
+    # Frame images aren't cached, so they can't be exported during replay
+    exporter = None
+    if args.export and replay:
+        print("[!] --export is ignored when replaying cached segments, as "
+              "frame images aren't cached. Remove the segment cache to "
+              "export segments.")
+    elif args.export:
+        exporter = ioe.SegmentExporter(output_dir / "segments",
+                                       args.export_format,
+                                       append=state is not None)
+
+    for frames in frame_batches:
+        # Classify segments in a background worker while the next queue is
+        # segmented, then track frames from any queues that are classified
+        if args.classify:
+            worker.submit(frames)
+            for classified_frames in worker.completed():
+                track_frames(classified_frames, tracker, exporter)
+        else:
+            track_frames(frames, tracker, exporter)
+
+        if args.live:
+            live.update(tracker.detected_events,
+                        tracker.get_cached_frame().frame_number)
+
+        if checkpointer is not None and args.checkpoint_interval > 0:
+            checkpointer.save_if_due(tracker)
+
+        queue_depths = {"classifier": len(worker)} if args.classify else {}
+        if exporter is not None:
+            queue_depths["export"] = len(exporter)
+        mt.metrics.update(frames[-1].frame_number - reader.start_frame + 1,
+                          sum(frame.get_num_segments() for frame in frames),
+                          len(tracker.detected_events), queue_depths)
+
+        prof.sample_memory(frames[-1].frame_number, {
+            "detected_events": len(tracker.detected_events),
+            "event_segments": sum(len(event)
+                                  for event in tracker.detected_events),
+        })
+
+    if args.classify:
+        for classified_frames in worker.completed(wait=True):
+            track_frames(classified_frames, tracker, exporter)
+        worker.close()
+
+    if exporter is not None:
+        exporter.close()
+
+    if args.live:
+        live.finalize(tracker.detected_events)
+
+    return copy.deepcopy(tracker.detected_events)
+
+
+class LiveCounter:
+    """Classifies events while a video is still being processed, and
+    writes provisional per-minute counts each time another minute of
+    video has been processed."""
+
+    def __init__(self, reader, output_dir):
+        self.reader = reader
+        self.classifier = ec.IncrementalEventClassifier()
+        self.minutes_reported = 0
+        self.output_dir = output_dir
+        self.provisional_count = 0
+
+    def update(self, detected_events, last_frame_number):
+        self.classifier.update(detected_events[self.classifier.n_events:])
+
+        minutes = int(last_frame_number / self.reader.fps // 60)
+        if minutes > self.minutes_reported:
+            self.minutes_reported = minutes
+            self.report()
+
+    def report(self):
+        df_labels = self.classifier.provisional_labels()
+        df_minutes = dio.count_events_per_period(df_labels, self.reader.fps,
+                                                 self.reader.start_frame,
+                                                 self.reader.end_frame, 60)
+
+        self.provisional_count = int(df_minutes["predicted"].sum())
+        ui.provisional_count_status(self.minutes_reported,
+                                    self.provisional_count,
+                                    int(df_minutes["rejected"].sum()))
+
+        if not self.output_dir.exists():
+            Path.mkdir(self.output_dir, parents=True)
+        df_minutes.to_csv(str(self.output_dir / "provisional-swifts_min.csv"))
+
+    def finalize(self, detected_events):
+        """Reconcile provisional counts once every event is known."""
+
+        self.classifier.update(detected_events[self.classifier.n_events:])
+        final_count = int(np.sum(self.classifier.finalize()["label"] > 0))
+        ui.reconciled_count_status(self.provisional_count, final_count)
+
+
+def track_frames(frames, tracker, exporter=None):
+    """Track segments through a list of frames, one-by-one in order."""
+
+    for frame in frames:
+        tracker.track_frame(frame)
+
+        if exporter is not None:
+            exporter.submit(frame)
+
+
+def load_result_cache(args):
+    """Open the result cache, either in the default location or in a
+    user-specified directory."""
+
+    max_bytes = int(args.result_cache_size * 2**30)
+    if args.result_cache == "default":
+        return ioc.ResultCache(max_bytes=max_bytes)
+    else:
+        return ioc.ResultCache(args.result_cache, max_bytes)
+
+
+def load_prefilter(args):
+    """Load prefilter thresholds, either from the default location
+    next to the model or from a user-specified file."""
+
+    if args.prefilter is None:
+        return None
+
+    import swiftwatcher.segment_classification as sc
+    if args.prefilter == "default":
+        return sc.SegmentPrefilter.load()
+    else:
+        return sc.SegmentPrefilter.load(args.prefilter)
@@ -0,0 +1,364 @@
+"""
+    Contains functionality to measure where time (and memory) is spent
+    within the swift counting algorithm. Each stage of the algorithm is
+    timed using the module-level profiler, and memory usage is sampled
+    using the module-level memory monitor. Both do nothing unless enabled.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+import threading
+import tracemalloc
+import time
+import json
+import gc
+import os
+import csv
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+MB = 2**20
+
+
+###############################################################################
+#                            TIME PROFILING BEGINS HERE                       #
+###############################################################################
+
+
+class Profiler:
+    """Accumulates the time spent in each named stage, as well as the
+    number of calls, frames and segments handled by that stage. Stages
+    may be timed from multiple threads (e.g. the classifier worker).
+
+    If tracemalloc is tracing (see MemoryMonitor), the peak memory
+    allocated while inside each stage is also recorded."""
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.start_time = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, frames=0, segments=0):
+        """Context manager which times the enclosed block of code."""
+
+        if not self.enabled:
+            yield
+            return
+
+        # Peak can only be reset in Python 3.9+
+        tracing = (tracemalloc.is_tracing() and
+                   hasattr(tracemalloc, "reset_peak"))
+        if tracing:
+            self.enter_memory_stage()
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak = self.exit_memory_stage() if tracing else None
+            self.record(name, seconds, frames, segments, peak)
+
+    def enter_memory_stage(self):
+        """Reset tracemalloc's peak so that it reflects this stage only.
+        As resetting also affects any enclosing stage (e.g. "rpca_svd"
+        within "rpca"), the enclosing stage's peak so far is saved on a
+        stack, then restored when this stage exits."""
+
+        if not hasattr(self.local, "peaks"):
+            self.local.peaks = []
+        if self.local.peaks:
+            self.local.peaks[-1] = max(self.local.peaks[-1],
+                                       tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        self.local.peaks.append(0)
+
+    def exit_memory_stage(self):
+        peak = max(self.local.peaks.pop(), tracemalloc.get_traced_memory()[1])
+        if self.local.peaks:
+            self.local.peaks[-1] = max(self.local.peaks[-1], peak)
+
+        return peak
+
+    def record(self, name, seconds, frames=0, segments=0, peak_bytes=None):
+        """Add a measured duration (and optionally, peak memory) to a
+        stage."""
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = {"calls": 0, "seconds": 0.0,
+                                     "frames": 0, "segments": 0,
+                                     "peak_mb": None}
+            stage = self.stages[name]
+            stage["calls"] += 1
+            stage["seconds"] += seconds
+            stage["frames"] += frames
+            stage["segments"] += segments
+            if peak_bytes is not None:
+                stage["peak_mb"] = max(stage["peak_mb"] or 0,
+                                       peak_bytes / MB)
+
+    def merge(self, rows, counters):
+        """Add the report and counters of another profiler (e.g. from a
+        worker process) to this one."""
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            for row in rows:
+                if row["stage"] not in self.stages:
+                    self.stages[row["stage"]] = {"calls": 0, "seconds": 0.0,
+                                                 "frames": 0, "segments": 0,
+                                                 "peak_mb": None}
+                stage = self.stages[row["stage"]]
+                for key in ["calls", "seconds", "frames", "segments"]:
+                    stage[key] += row[key]
+                if row["peak_mb"] is not None:
+                    stage["peak_mb"] = max(stage["peak_mb"] or 0,
+                                           row["peak_mb"])
+
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def count(self, name, value=1):
+        """Add to a counter which isn't tied to a timed stage (e.g. the
+        number of iterations needed for RPCA to converge)."""
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        """Summarize every stage as a list of dictionaries."""
+
+        with self.lock:
+            rows = []
+            for name, stage in self.stages.items():
+                row = OrderedDict(stage=name, **stage)
+                row["ms_per_call"] = 1000 * stage["seconds"] / stage["calls"]
+                row["ms_per_frame"] = None
+                if stage["frames"]:
+                    row["ms_per_frame"] = \
+                        1000 * stage["seconds"] / stage["frames"]
+                rows.append(row)
+
+        return rows
+
+    def save(self, output_dir, video_name, extra=None):
+        """Write the report to profile.json and profile.csv."""
+
+        rows = self.report()
+        wall_seconds = time.perf_counter() - self.start_time
+        report = OrderedDict(video=video_name, wall_seconds=wall_seconds,
+                             stages=rows, counters=dict(self.counters))
+        if extra:
+            report.update(extra)
+
+        output_dir = Path(output_dir)
+        if not output_dir.exists():
+            Path.mkdir(output_dir, parents=True)
+
+        with open(str(output_dir / "profile.json"), "w") as json_file:
+            json.dump(report, json_file, indent=4)
+
+        with open(str(output_dir / "profile.csv"), "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["stage", "calls", "seconds",
+                                                   "frames", "segments",
+                                                   "peak_mb", "ms_per_call",
+                                                   "ms_per_frame"])
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+# Shared profiler used by every module of the algorithm
+profiler = Profiler()
+
+
+def stage(name, frames=0, segments=0):
+    return profiler.stage(name, frames, segments)
+
+
+def record(name, seconds, frames=0, segments=0):
+    profiler.record(name, seconds, frames, segments)
+
+
+def count(name, value=1):
+    profiler.count(name, value)
+
+
+###############################################################################
+#                          MEMORY ACCOUNTING BEGINS HERE                      #
+###############################################################################
+
+
+class MemoryMonitor:
+    """Records a time series of memory usage while a video is processed,
+    to find which structures are responsible for high memory usage.
+    Each sample (taken once per queue of frames) records:
+
+        -RSS of the process and memory currently traced by tracemalloc
+        -The number of live instances of each tracked type (e.g. Frame,
+         Segment), as well as the bytes of arrays those instances hold
+        -Any extra values passed in (e.g. the number of detected events)
+
+    Snapshots of the largest allocation sites are also taken at a
+    (less frequent) interval. Tracking has a significant overhead, so
+    it should only be enabled when diagnosing memory usage."""
+
+    def __init__(self):
+        self.enabled = False
+        self.tracked_types = []
+        self.reset()
+
+    def reset(self):
+        self.samples = []
+        self.snapshots = []
+        self.start_time = time.perf_counter()
+
+    def start(self, tracked_types=(), snapshot_interval=10, n_top=10):
+        self.enabled = True
+        self.tracked_types = list(tracked_types)
+        self.snapshot_interval = snapshot_interval
+        self.n_top = n_top
+        self.reset()
+        tracemalloc.start()
+
+    def stop(self):
+        self.enabled = False
+        tracemalloc.stop()
+
+    def sample(self, frame_number, extra=None):
+        """Record the memory usage at the current point in time."""
+
+        if not self.enabled:
+            return
+
+        traced, traced_peak = tracemalloc.get_traced_memory()
+        row = OrderedDict(seconds=time.perf_counter() - self.start_time,
+                          frame_number=frame_number,
+                          rss_mb=get_rss_bytes() / MB,
+                          traced_mb=traced / MB,
+                          traced_peak_mb=traced_peak / MB)
+        row.update(count_live_objects(self.tracked_types))
+        if extra:
+            row.update(extra)
+        self.samples.append(row)
+
+        if (len(self.samples) - 1) % self.snapshot_interval == 0:
+            self.take_snapshot(frame_number)
+
+    def take_snapshot(self, frame_number):
+        """Store the largest allocation sites (by line of code)."""
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)])
+        statistics = snapshot.statistics("lineno")[:self.n_top]
+        for rank, stat in enumerate(statistics):
+            frame = stat.traceback[0]
+            self.snapshots.append(OrderedDict(
+                frame_number=frame_number, rank=rank,
+                site="{}:{}".format(frame.filename, frame.lineno),
+                size_mb=stat.size / MB, count=stat.count))
+
+    def save(self, output_dir):
+        """Write samples to memory.csv and snapshots to
+        memory_snapshots.csv."""
+
+        output_dir = Path(output_dir)
+        if not output_dir.exists():
+            Path.mkdir(output_dir, parents=True)
+
+        for filename, rows in [("memory.csv", self.samples),
+                               ("memory_snapshots.csv", self.snapshots)]:
+            if not rows:
+                continue
+            fieldnames = list(OrderedDict.fromkeys(
+                key for row in rows for key in row))
+            with open(str(output_dir / filename), "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=fieldnames)
+                writer.writeheader()
+                writer.writerows(rows)
+
+
+def get_rss_bytes():
+    """Current resident set size of this process. Falls back to the
+    peak RSS where the current RSS isn't available (i.e. not Linux)."""
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    if resource is not None:
+        # ru_maxrss is reported in kilobytes on Linux, bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    return 0
+
+
+def count_live_objects(tracked_types):
+    """Count the live instances of each type, as well as the bytes of
+    array buffers (e.g. frame images) held by those instances, either
+    directly or within dictionaries. Arrays which share memory (views)
+    are only counted once."""
+
+    counts = OrderedDict()
+    for tracked_type in tracked_types:
+        counts[tracked_type.__name__] = 0
+        counts[tracked_type.__name__ + "_buffer_mb"] = 0
+
+    seen_buffers = set()
+    for obj in gc.get_objects():
+        for tracked_type in tracked_types:
+            if isinstance(obj, tracked_type):
+                name = tracked_type.__name__
+                counts[name] += 1
+                counts[name + "_buffer_mb"] += \
+                    get_buffer_bytes(obj, seen_buffers) / MB
+
+    return counts
+
+
+def get_buffer_bytes(obj, seen_buffers):
+    values = list(vars(obj).values())
+    for value in list(values):
+        if isinstance(value, dict):
+            values.extend(value.values())
+
+    n_bytes = 0
+    for value in values:
+        if hasattr(value, "nbytes") and hasattr(value, "base"):
+            # A view keeps its entire base alive (e.g. a segment's patch
+            # keeps its full frame), so the base's size is what counts
+            base = value if value.base is None else value.base
+            if id(base) not in seen_buffers:
+                seen_buffers.add(id(base))
+                n_bytes += getattr(base, "nbytes", value.nbytes)
+
+    return n_bytes
+
+
+# Shared memory monitor, sampled once per queue of frames
+memory_monitor = MemoryMonitor()
+
+
+def sample_memory(frame_number, extra=None):
+    memory_monitor.sample(frame_number, extra)
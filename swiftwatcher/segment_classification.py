@@ -4,51 +4,522 @@
     from being treated as chimney swifts.
 """
 
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import copy
+import os
+
+import numpy as np
 import torch
 from torch import nn
 from torchvision import models, transforms
 
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+import swiftwatcher.image_filtering as img
+import swiftwatcher.profiling as prof
+import swiftwatcher.thread_budget as tb
+
+# Trained model weights are shipped alongside this module
+MODEL_PATH = Path(__file__).parent / "model.pt"
+PREFILTER_PATH = Path(__file__).parent / "prefilter.json"
+
+# Device is determined on first use to avoid probing CUDA at import
+_device = None
+
+# Prefilter decision for segments which must be passed to the CNN
+AMBIGUOUS = -1
+
+# Preprocessing parameters expected by the trained model
+PATCH_SIZE = 24
+INPUT_SIZE = 224
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
 
 
 class SegmentClassifier:
-    def __init__(self, model_path):
-        self.model = setup_model(2)
-        self.model.load_state_dict(torch.load(model_path))
+    def __init__(self, model_path=MODEL_PATH, batch_size=256,
+                 prefilter=None, quantized=False):
+        tb.configure_torch()
+        if quantized:
+            self.model = load_quantized_model(model_path)
+            self.device = torch.device("cpu")
+        else:
+            self.model = load_model(model_path)
+            self.device = get_device()
+        self.batch_size = batch_size
+        self.prefilter = prefilter
+
+        # Reference transforms the model was trained with. The faster
+        # preprocess() method is checked against these when loaded.
         self.transforms = [
             transforms.ToPILImage(),
-            transforms.Resize((24, 24)),
-            transforms.Pad((224 - 24)//2),
+            transforms.Resize((PATCH_SIZE, PATCH_SIZE)),
+            transforms.Pad((INPUT_SIZE - PATCH_SIZE)//2),
             transforms.ToTensor(),
-            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+            transforms.Normalize(MEAN.tolist(), STD.tolist())
         ]
 
+        # Most segments are already at the patch size, so preprocessing
+        # of those patches must match the reference exactly
+        max_diff, matches = self.verify_preprocessing(sample_patches())
+        if not matches:
+            print("[!] Segment preprocessing differs from the classifier's "
+                  "training transforms (max. difference {:.3g})."
+                  .format(max_diff))
+
     def __call__(self, segments):
-        segments_to_keep = []
+        """Classify the segments of a single frame, returning only the
+        segments predicted to be chimney swifts."""
+
+        return filter_segments(segments, self.predict(segments))
+
+    def classify_frames(self, frames):
+        """Classify the segments of many frames (e.g. an entire
+        FrameQueue) together, so that the CNN is run on large batches
+        rather than once per segment."""
+
+        segments = [segment for frame in frames for segment in frame.segments]
+        with prof.stage("classification", frames=len(frames),
+                        segments=len(segments)):
+            predictions = self.predict(segments)
+
+        start = 0
+        for frame in frames:
+            end = start + len(frame.segments)
+            frame.segments = filter_segments(frame.segments,
+                                             predictions[start:end])
+            start = end
+
+        return frames
+
+    def predict(self, segments):
+        """Return a list of predicted labels (1 = chimney swift) for
+        a list of segments. If a prefilter is set, only segments it
+        considers ambiguous are passed to the CNN."""
+
+        if self.prefilter is None:
+            return self.predict_cnn(segments)
+
+        predictions = self.prefilter(segments)
+        ambiguous = np.flatnonzero(predictions == AMBIGUOUS)
+        if len(ambiguous) > 0:
+            predictions[ambiguous] = \
+                self.predict_cnn([segments[i] for i in ambiguous])
 
-        for segment in segments:
-            x = segment.segment_image
+        return predictions.tolist()
+
+    def predict_cnn(self, segments):
+        """Return a list of CNN-predicted labels for a list of
+        segments, using batches of at most batch_size."""
+
+        return predict_images(self.model,
+                              [segment.segment_image for segment in segments],
+                              self.batch_size, self.device)
+
+    def preprocess(self, segments):
+        """Convert segment images into a single normalized batch tensor.
+        Equivalent to self.transforms, but patches are resized with
+        OpenCV directly into a preallocated array and normalized in
+        bulk, rather than being passed through PIL one at a time."""
+
+        return images_to_batch([segment.segment_image for segment in segments])
+
+    def preprocess_reference(self, images):
+        """Apply the reference transforms to each segment image, then
+        stack the results into a single batch tensor."""
+
+        tensors = []
+        for x in images:
             for transform in self.transforms:
                 x = transform(x)
-            x = x.unsqueeze(0)
-            x = x.to(device)
-            score = self.model(x)
-            _, y_pred = torch.max(score, 1)
+            tensors.append(x)
+
+        return torch.stack(tensors)
+
+    def verify_preprocessing(self, images, atol=1e-5):
+        """Compare preprocess() against the reference transforms for a
+        list of segment images. Returns the maximum absolute difference,
+        and whether it falls within the given tolerance."""
+
+        fast = images_to_batch(images)
+        reference = self.preprocess_reference(images)
+        max_diff = float(torch.max(torch.abs(fast - reference)))
+
+        return max_diff, max_diff <= atol
+
+
+class ClassifierWorker:
+    """Runs a SegmentClassifier in a background thread, so that the
+    classification of one queue of frames overlaps with segmentation
+    of the next. (Both PyTorch and NumPy's SVD release the GIL.)
+
+    Classified frames are returned in the order they were submitted."""
+
+    def __init__(self, classifier, max_pending=2):
+        self.classifier = classifier
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = deque()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def submit(self, frames):
+        self.pending.append(self.executor.submit(
+            self.classifier.classify_frames, frames))
+
+    def completed(self, wait=False):
+        """Yield lists of classified frames that are ready, in order.
+        Blocks if too many are pending (or if wait=True, until every
+        pending list has been classified)."""
+
+        while self.pending and (wait or self.pending[0].done() or
+                                len(self.pending) > self.max_pending):
+            yield self.pending.popleft().result()
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class SegmentPrefilter:
+    """Cheap first-stage classifier which uses the shape features from
+    image_filtering.get_segment_features() to reject obvious non-swift
+    segments (e.g. noise, seagulls) and accept obvious swift segments.
+    Only the remaining, ambiguous segments need to be passed to the CNN.
+
+    Any threshold set to None is disabled. Thresholds can be learned
+    from labeled segments using fit_prefilter()."""
+
+    THRESHOLDS = ["reject_area_min", "reject_area_max",
+                  "reject_aspect_max", "reject_intensity_max",
+                  "accept_area_min", "accept_area_max",
+                  "accept_aspect_max", "accept_intensity_max"]
+
+    def __init__(self, thresholds=None):
+        self.thresholds = {key: None for key in self.THRESHOLDS}
+        if thresholds:
+            self.thresholds.update(thresholds)
+
+    def __call__(self, segments):
+        return self.decide(img.get_segment_features(segments))
+
+    def decide(self, features):
+        """Return an array of decisions (1 = accept, 0 = reject,
+        AMBIGUOUS = defer to CNN) for an (N, 3) array of features."""
+
+        t = self.thresholds
+        area, aspect, intensity = features.T
+        nothing = np.zeros(len(features), dtype=bool)
+
+        def below(values, threshold):
+            return values < threshold if threshold is not None else nothing
+
+        def above(values, threshold):
+            return values > threshold if threshold is not None else nothing
+
+        reject = (below(area, t["reject_area_min"]) |
+                  above(area, t["reject_area_max"]) |
+                  above(aspect, t["reject_aspect_max"]) |
+                  above(intensity, t["reject_intensity_max"]))
+
+        # Accept box is disabled entirely unless all of its bounds are set
+        if all(t[key] is not None for key in self.THRESHOLDS[4:]):
+            accept = (~below(area, t["accept_area_min"]) &
+                      ~above(area, t["accept_area_max"]) &
+                      ~above(aspect, t["accept_aspect_max"]) &
+                      ~above(intensity, t["accept_intensity_max"]))
+        else:
+            accept = nothing
+
+        decisions = np.full(len(features), AMBIGUOUS)
+        decisions[accept] = 1
+        decisions[reject] = 0
+
+        return decisions
+
+    def save(self, filepath=PREFILTER_PATH):
+        with open(str(filepath), "w") as json_file:
+            json.dump(self.thresholds, json_file, indent=4)
+
+    @classmethod
+    def load(cls, filepath=PREFILTER_PATH):
+        with open(str(filepath)) as json_file:
+            return cls(json.load(json_file))
+
+
+def fit_prefilter(features, labels, purity=0.99, reject_quantile=0.0):
+    """Learn prefilter thresholds from an (N, 3) array of segment
+    features and their ground truth labels (1 = chimney swift).
+
+    Reject thresholds are placed at the extremes of the swift features
+    (optionally trimmed by reject_quantile), so that no (or very few)
+    training swifts are rejected. The accept box is shrunk around the
+    median swift until at least 'purity' of the segments inside it are
+    swifts. If no such box exists, accepting is left disabled."""
+
+    features = np.asarray(features, dtype=float)
+    labels = np.asarray(labels)
+    positives = features[labels == 1]
+    if len(positives) == 0:
+        raise ValueError("Cannot fit prefilter without positive samples.")
+
+    lower = np.quantile(positives, reject_quantile, axis=0)
+    upper = np.quantile(positives, 1 - reject_quantile, axis=0)
+    thresholds = {
+        "reject_area_min": float(lower[0]),
+        "reject_area_max": float(upper[0]),
+        "reject_aspect_max": float(upper[1]),
+        "reject_intensity_max": float(upper[2]),
+    }
+
+    for q in np.arange(0.05, 0.5, 0.05):
+        lower = np.quantile(positives, q, axis=0)
+        upper = np.quantile(positives, 1 - q, axis=0)
+        inside = ((features[:, 0] >= lower[0]) & (features[:, 0] <= upper[0]) &
+                  (features[:, 1] <= upper[1]) & (features[:, 2] <= upper[2]))
+
+        if np.any(inside) and np.mean(labels[inside] == 1) >= purity:
+            thresholds.update({
+                "accept_area_min": float(lower[0]),
+                "accept_area_max": float(upper[0]),
+                "accept_aspect_max": float(upper[1]),
+                "accept_intensity_max": float(upper[2]),
+            })
+            break
+
+    return SegmentPrefilter(thresholds)
+
+
+def predict_images(model, images, batch_size, device):
+    """Return a list of predicted labels for a list of segment images,
+    using batches of at most batch_size."""
+
+    predictions = []
+
+    with torch.no_grad():
+        for i in range(0, len(images), batch_size):
+            batch = images_to_batch(images[i:i + batch_size])
+            scores = model(batch.to(device))
+            _, y_pred = torch.max(scores, 1)
+            predictions.extend(y_pred.tolist())
+
+    return predictions
+
+
+def sample_patches(n=8, seed=0):
+    """Random segment images at the patch size, for verifying
+    preprocessing without any real segments."""
+
+    rng = np.random.RandomState(seed)
+
+    return list(rng.randint(0, 256, (n, PATCH_SIZE, PATCH_SIZE, 3),
+                            dtype=np.uint8))
+
+
+def images_to_batch(images):
+    """Convert a list of segment images into a normalized batch tensor."""
+
+    return torch.from_numpy(pad_and_normalize(
+        img.resize_patches(images, PATCH_SIZE)))
+
+
+def pad_and_normalize(patches, input_size=INPUT_SIZE):
+    """Normalize a (N, H, W, 3) uint8 array of patches and place each
+    patch at the center of a zero-padded (N, 3, input_size, input_size)
+    float32 array, matching ToTensor(), Pad() and Normalize()."""
+
+    n, h, w, _ = patches.shape
+    top, left = (input_size - h)//2, (input_size - w)//2
+
+    # Padding is applied before normalization, so pad value is -mean/std
+    batch = np.empty((n, 3, input_size, input_size), dtype=np.float32)
+    batch[:] = (-MEAN / STD)[None, :, None, None]
+
+    normalized = (patches.astype(np.float32) / 255 - MEAN) / STD
+    batch[:, :, top:top + h, left:left + w] = normalized.transpose(0, 3, 1, 2)
+
+    return batch
+
+
+def filter_segments(segments, predictions):
+    """Keep segments with a positive prediction, then relabel the kept
+    segments so labels remain consecutive."""
+
+    segments_to_keep = [segment for segment, y_pred
+                        in zip(segments, predictions) if y_pred == 1]
+
+    for i, segment in enumerate(segments_to_keep):
+        segment.label = i+1
+
+    return segments_to_keep
+
+
+def get_device():
+    """Return the device used for inference, checking for CUDA only
+    the first time a model is loaded."""
+
+    global _device
+    if _device is None:
+        _device = torch.device("cuda:0" if torch.cuda.is_available()
+                               else "cpu")
+
+    return _device
+
+
+def get_artifact_path(model_path, quantized=False):
+    """Return the path of the serialized TorchScript artifact which is
+    cached next to the model's state dict."""
+
+    model_path = Path(model_path)
+    suffix = ".int8.torchscript.pt" if quantized else ".torchscript.pt"
+
+    return model_path.with_name(model_path.stem + suffix)
+
+
+def load_model(model_path):
+    """Load a ready-to-use model for inference without network access.
+
+    If a TorchScript artifact newer than the state dict exists, it is
+    loaded directly. Otherwise (or if the artifact can't be loaded, e.g.
+    it is corrupt), the model is built from the state dict and the
+    artifact is created so that later runs can start quickly."""
+
+    model_path = Path(model_path)
+    artifact_path = get_artifact_path(model_path)
+
+    if (artifact_path.is_file() and
+            artifact_path.stat().st_mtime >= model_path.stat().st_mtime):
+        try:
+            return torch.jit.load(str(artifact_path),
+                                  map_location=get_device())
+        except (OSError, RuntimeError, ValueError) as e:
+            print("[!] Rebuilding unreadable model artifact '{}' ({})."
+                  .format(artifact_path.name, e))
+
+    model = setup_model(2)
+    model.load_state_dict(torch.load(str(model_path),
+                                     map_location=get_device()))
+    model.eval()
+
+    example = torch.zeros((1, 3, INPUT_SIZE, INPUT_SIZE),
+                          device=get_device())
+    with torch.no_grad():
+        scripted_model = torch.jit.freeze(torch.jit.trace(model, example))
+
+    # Caching is an optimization only (e.g. package dir may be read-only)
+    try:
+        save_artifact(scripted_model, artifact_path)
+    except (OSError, RuntimeError):
+        print("[!] Could not cache model artifact to '{}'."
+              .format(artifact_path))
+
+    return scripted_model
+
+
+def save_artifact(scripted_model, artifact_path):
+    """Save a TorchScript artifact atomically, so that processes loading
+    it concurrently (e.g. with --jobs) never see a partial file."""
+
+    tmp_path = artifact_path.with_name(".{}.{}.tmp".format(
+        artifact_path.name, os.getpid()))
+    try:
+        torch.jit.save(scripted_model, str(tmp_path))
+        os.replace(str(tmp_path), str(artifact_path))
+    finally:
+        if tmp_path.exists():
+            os.remove(str(tmp_path))
+
+
+def load_quantized_model(model_path):
+    """Load the int8 quantized TorchScript artifact for CPU inference.
+    Unlike the float artifact, it can't be created automatically, as
+    quantization requires calibration data. (See quantize_model().)"""
+
+    artifact_path = get_artifact_path(model_path, quantized=True)
+    if not artifact_path.is_file():
+        raise FileNotFoundError("Quantized model '{}' not found. Create it "
+                                "using research/scripts/quantize_classifier.py"
+                                .format(artifact_path))
+
+    # A corrupt artifact can't be rebuilt here, unlike the float artifact
+    try:
+        return torch.jit.load(str(artifact_path), map_location="cpu")
+    except (OSError, RuntimeError, ValueError) as e:
+        raise RuntimeError("Quantized model '{}' could not be loaded ({}). "
+                           "Recreate it using research/scripts/"
+                           "quantize_classifier.py".format(artifact_path, e))
+
+
+def quantize_model(model_path, calibration_images, batch_size=256):
+    """Create an int8 version of the model using static post-training
+    quantization. (Dynamic quantization only applies to linear and
+    recurrent layers, and SqueezeNet is almost entirely convolutional.)
+    Activation ranges are calibrated using a list of segment images.
+
+    The float model is returned alongside the quantized model so that
+    they can be compared using evaluate_quantized_model()."""
+
+    # Imported here, as quantization APIs are not needed for inference
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    float_model = setup_model(2).cpu()
+    float_model.load_state_dict(torch.load(str(model_path),
+                                           map_location="cpu"))
+    float_model.eval()
+
+    example = torch.zeros((1, 3, INPUT_SIZE, INPUT_SIZE))
+    prepared_model = prepare_fx(copy.deepcopy(float_model),
+                                get_default_qconfig_mapping("fbgemm"),
+                                (example,))
+
+    # Observers record activation ranges while calibration data is passed
+    predict_images(prepared_model, calibration_images, batch_size, "cpu")
+
+    with torch.no_grad():
+        quantized_model = torch.jit.trace(convert_fx(prepared_model), example)
+
+    return float_model, quantized_model
+
+
+def evaluate_quantized_model(float_model, quantized_model, images,
+                             labels=None, batch_size=256):
+    """Compare a quantized model against its float counterpart on a
+    held-out set of segment images. Returns the fraction of images on
+    which the two models agree, as well as the accuracy of each model
+    if ground truth labels are provided."""
+
+    float_predictions = np.array(predict_images(float_model, images,
+                                                batch_size, "cpu"))
+    quantized_predictions = np.array(predict_images(quantized_model, images,
+                                                    batch_size, "cpu"))
+
+    results = {"agreement": float(np.mean(float_predictions ==
+                                          quantized_predictions))}
+    if labels is not None:
+        labels = np.asarray(labels)
+        results["float_accuracy"] = float(np.mean(float_predictions == labels))
+        results["quantized_accuracy"] = \
+            float(np.mean(quantized_predictions == labels))
+
+    return results
 
-            if y_pred == 1:
-                segments_to_keep.append(segment)
 
-        for i, segment in enumerate(segments_to_keep):
-            segment.label = i+1
+def save_quantized_model(quantized_model, model_path):
+    """Save the quantized model next to the model's state dict, where
+    it will be found by load_quantized_model()."""
 
-        return segments_to_keep
+    save_artifact(quantized_model,
+                  get_artifact_path(model_path, quantized=True))
 
 
 def setup_model(num_classes):
     """Select CNN architecture, modified for transfer learning on
-    specific dataset."""
+    specific dataset. Pretrained weights are not loaded, as they are
+    replaced by the weights of the trained model."""
     # Call model constructor
-    model = models.squeezenet1_0(pretrained=True)
+    model = models.squeezenet1_0()
 
     # Freeze layer parameters if feature extracting
     for param in model.parameters():
@@ -62,6 +533,6 @@ def setup_model(num_classes):
     model.num_classes = num_classes
 
     # Send the model to GPU
-    model = model.to(device)
+    model = model.to(get_device())
 
     return model
@@ -12,6 +12,15 @@ from scipy.spatial import distance
 from scipy.optimize import linear_sum_assignment
 
 import swiftwatcher.data_structures as ds
+import swiftwatcher.profiling as prof
+
+# Default parameters used to formulate tracking costs. (See the
+# calculate_*_cost functions below.)
+TRACKING_PARAMS = {
+    "distance_offset": 25,
+    "angle_offset": 90,
+    "nonmatch_cost": 1,
+}
 
 
 class SegmentTracker:
@@ -23,10 +32,15 @@ class SegmentTracker:
     Functions that explicitly use frame segments are treated as class
     methods, while more generic functions are stored separately."""
 
-    def __init__(self, roi_mask):
+    def __init__(self, roi_mask, params=None):
         self.current_frame = None
         self.cached_frame = ds.Frame()  # Empty frame object
 
+        # Cost parameters, with any unspecified values set to defaults
+        self.params = dict(TRACKING_PARAMS)
+        if params:
+            self.params.update(params)
+
         # Used when detecting a "swift entered chimney" event
         self.roi_mask = roi_mask
         self.detected_events = []
@@ -43,6 +57,24 @@ class SegmentTracker:
     def cache_current_frame(self):
         self.cached_frame = self.current_frame
 
+    def track_frame(self, frame):
+        """Apply every tracking step to match the segments of a new
+        frame to those of the previous frame."""
+
+        n_segments = frame.get_num_segments()
+        self.set_current_frame(frame)
+
+        with prof.stage("cost_matrix", frames=1, segments=n_segments):
+            cost_matrix = self.formulate_cost_matrix()
+
+        with prof.stage("assignment", frames=1, segments=n_segments):
+            self.store_assignments(apply_hungarian_algorithm(cost_matrix))
+
+        with prof.stage("events", frames=1, segments=n_segments):
+            self.link_matching_segments()
+            self.check_for_events()
+            self.cache_current_frame()
+
     def formulate_cost_matrix(self):
         """Formulate a matrix containing costs for every combination
         of segments within two frames. Example: Matching 4 segments in
@@ -84,20 +116,25 @@ class SegmentTracker:
         n_curr = current_frame.get_num_segments()
         n_prev = previous_frame.get_num_segments()
 
-        cost_matrix = intialize_cost_matrix(n_curr, n_prev)
+        nonmatch_cost = calculate_nonmatch_cost(self.params["nonmatch_cost"])
+        cost_matrix = intialize_cost_matrix(n_curr, n_prev, nonmatch_cost)
 
         # Only calculate match costs if both frames have segments
         if n_curr > 0 and n_prev > 0:
             for i, segment_prev in enumerate(previous_frame.segments):
                 for j, segment_curr in enumerate(current_frame.segments):
-                    d_cost = calculate_distance_cost(segment_curr, segment_prev)
-                    a_cost = calculate_angle_cost(segment_curr, segment_prev)
+                    d_cost = calculate_distance_cost(
+                        segment_curr, segment_prev,
+                        self.params["distance_offset"])
+                    a_cost = calculate_angle_cost(
+                        segment_curr, segment_prev,
+                        self.params["angle_offset"])
 
                     # The second index requires an offset, see matrix def
                     cost_matrix[i, j + n_prev] = 0.5*d_cost + 0.5*a_cost
 
         for i in range(n_curr + n_prev):
-            cost_matrix[i, i] = calculate_nonmatch_cost()
+            cost_matrix[i, i] = nonmatch_cost
 
         return cost_matrix
 
@@ -176,28 +213,30 @@ class SegmentTracker:
                 self.detected_events.append(event_motion_path)
 
 
-def intialize_cost_matrix(n_curr, n_prev):
+def intialize_cost_matrix(n_curr, n_prev, nonmatch_cost=1):
     """Initialize a square cost matrix with size equal to the total
     segments across both frames. Values set to slightly larger than the
-    default "no match" value."""
+    "no match" value."""
 
     n_total = n_curr + n_prev
 
-    return np.ones((n_total, n_total)) + sys.float_info.epsilon
+    return (np.full((n_total, n_total), float(nonmatch_cost)) +
+            sys.float_info.epsilon)
 
 
-def calculate_distance_cost(segment_curr, segment_prev):
+def calculate_distance_cost(segment_curr, segment_prev, offset=25):
     """Map the distance between segments into a cost for the cost
-    matrix. Higher distances mean larger costs."""
+    matrix. Higher distances mean larger costs. Distances below the
+    offset (in pixels) map to costs below 1."""
 
     dist = distance.euclidean(segment_prev.centroid,
                               segment_curr.centroid)
-    dist_cost = 2 ** (dist - 25)
+    dist_cost = 2 ** (dist - offset)
 
     return dist_cost
 
 
-def calculate_angle_cost(segment_curr, segment_prev):
+def calculate_angle_cost(segment_curr, segment_prev, offset=90):
     """Compare the angle of the vector between seg_curr and seg_prev to
     the angle of vector associated with the existing motion path. Angle
     difference falls within range [0, 180]. Example:
@@ -210,7 +249,7 @@ def calculate_angle_cost(segment_curr, segment_prev):
                                             * = prior matched segments
 
     There is a low cost if the (o, .) vector is similar to the (*, o)
-    vector. (i.e. <90 degrees)"""
+    vector. (i.e. <90 degrees, or more generally, < offset)"""
 
     if len(segment_prev.segment_history) > 0:
         # Get the (x, y) coordinates of:
@@ -238,7 +277,7 @@ def calculate_angle_cost(segment_curr, segment_prev):
         angle_difference = min(angle_difference, 360 - angle_difference)
 
         # Map differences <90 to a low cost, and >90 to a high cost
-        angle_cost = 2 ** (angle_difference - 90)
+        angle_cost = 2 ** (angle_difference - offset)
 
     else:
         # No prior matched segments, so use a default value
@@ -247,11 +286,11 @@ def calculate_angle_cost(segment_curr, segment_prev):
     return angle_cost
 
 
-def calculate_nonmatch_cost():
+def calculate_nonmatch_cost(cost=1):
     """Current costs for segment pairs not matching is set to a
     default value of 1."""
 
-    return 1
+    return cost
 
 
 def apply_hungarian_algorithm(cost_matrix):
@@ -0,0 +1,144 @@
+"""
+    Contains functionality for limiting the number of threads used by
+    each process. NumPy's BLAS (e.g. the SVD within RPCA), OpenCV and
+    torch each start one thread per core by default, so when several
+    processes run at once (--jobs, --workers), the machine is heavily
+    oversubscribed. A single budget (--threads, by default one thread
+    per core) is instead divided between concurrent processes, and each
+    process applies its share to every thread pool consistently.
+
+    BLAS and OpenMP read their thread counts from environment variables
+    when they are first loaded, so the variables are set before child
+    processes are started (which must be spawned, not forked, so that
+    they load these libraries afresh). Within a process which has
+    already loaded NumPy (e.g. the main process), BLAS can only be
+    limited using threadpoolctl.
+"""
+
+from contextlib import contextmanager
+import sys
+import os
+
+# Variables read by the BLAS and OpenMP implementations NumPy may use
+ENV_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+            "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+# Budget applied to this process, the limiter which enforces it, and
+# whether BLAS is actually limited to the budget
+configured_threads = None
+_limiter = None
+blas_limited = False
+
+
+def get_budget(args):
+    """Threads available to each process running a job. The total
+    budget is divided between the args.jobs concurrent jobs in batch
+    (manifest or work queue) mode."""
+
+    total = args.threads if args.threads is not None else os.cpu_count()
+    if args.manifest is not None or args.queue is not None:
+        total //= max(args.jobs, 1)
+
+    return max(total or 1, 1)
+
+
+def get_worker_budget(budget, n_workers):
+    """Threads available to each segmentation worker process, when a
+    job's budget is shared between n_workers workers."""
+
+    return max(budget // max(n_workers, 1), 1)
+
+
+def configure(n_threads):
+    """Limit every thread pool used by this process to n_threads. Safe
+    to call repeatedly (e.g. once per job in a worker process)."""
+
+    global configured_threads, _limiter, blas_limited
+    if n_threads == configured_threads:
+        return
+
+    configured_threads = n_threads
+    set_environment(n_threads)
+
+    import cv2
+    cv2.setNumThreads(n_threads)
+
+    # Only needed if BLAS was loaded before the environment was set
+    blas_limited = "numpy" not in sys.modules
+    if not blas_limited:
+        try:
+            from threadpoolctl import threadpool_limits
+            _limiter = threadpool_limits(limits=n_threads)
+            blas_limited = True
+        except ImportError:
+            _limiter = None
+            print("[!] NumPy's BLAS can't be limited to {} threads, as "
+                  "threadpoolctl isn't installed.".format(n_threads))
+
+    if "torch" in sys.modules:
+        configure_torch()
+
+
+def configure_torch():
+    """Apply the budget to torch, which is only imported if classifying
+    (so is configured when the classifier is loaded)."""
+
+    if configured_threads is None:
+        return
+
+    import torch
+    torch.set_num_threads(configured_threads)
+
+
+def set_environment(n_threads):
+    for var in ENV_VARS:
+        os.environ[var] = str(n_threads)
+
+
+@contextmanager
+def child_environment(n_threads):
+    """Temporarily set the environment inherited by child processes
+    started within the block, so that they load BLAS with their own
+    (smaller) budget."""
+
+    previous = {var: os.environ.get(var) for var in ENV_VARS}
+    set_environment(n_threads)
+    try:
+        yield
+    finally:
+        for var, value in previous.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def get_settings(n_workers=0):
+    """Effective thread settings of this process, for the profile."""
+
+    import cv2
+    settings = {"budget": configured_threads,
+                "cpu_count": os.cpu_count(),
+                "opencv": cv2.getNumThreads(),
+                "environment": {var: os.environ.get(var)
+                                for var in ENV_VARS}}
+
+    if n_workers > 0 and configured_threads is not None:
+        settings["segment_workers"] = n_workers
+        settings["threads_per_segment_worker"] = \
+            get_worker_budget(configured_threads, n_workers)
+
+    try:
+        from threadpoolctl import threadpool_info
+        settings["blas"] = [{"library": info["internal_api"],
+                             "threads": info["num_threads"]}
+                            for info in threadpool_info()]
+    except ImportError:
+        settings["blas"] = ("limited by the environment" if blas_limited
+                            else "not limited (threadpoolctl is not "
+                                 "installed)")
+
+    if "torch" in sys.modules:
+        settings["torch"] = sys.modules["torch"].get_num_threads()
+
+    return settings
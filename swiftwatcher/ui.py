@@ -8,11 +8,9 @@ import argparse
 from os import fspath
 from pathlib import Path
 
-import tkinter as tk
-from tkinter import filedialog
-
 import cv2
 import json
+import csv
 
 
 ###############################################################################
@@ -20,19 +18,113 @@ import json
 ###############################################################################
 
 
-def parse_args():
-    """Parse arguments related to algorithm experimentation."""
+def parse_args(argv=None):
+    """Parse arguments related to algorithm experimentation. Arguments
+    are taken from the command line unless a list (argv) is passed."""
+
+    args = build_parser().parse_args(argv)
+
+    args.filepaths = [Path(filepath).resolve() for filepath in args.filepaths]
+
+    # Manifests and queues are used for unattended runs, so never open a GUI
+    if args.manifest is not None:
+        args.manifest = Path(args.manifest).resolve()
+        args.headless = True
+    if args.queue is not None:
+        args.queue = Path(args.queue).resolve()
+        args.headless = True
+
+    return args
+
 
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", action="store_true")
     parser.add_argument("--filepaths", nargs="*", default=[])
     parser.add_argument("--start", type=int, default=0)
     parser.add_argument("--end", type=int, default=-1)
     parser.add_argument("--classify", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--prefilter", nargs="?", const="default")
+    parser.add_argument("--quantized", action="store_true")
     parser.add_argument("--export", action="store_true")
-    args = parser.parse_args()
-
-    args.filepaths = [Path(filepath).resolve() for filepath in args.filepaths]
+    parser.add_argument("--export-format", default="png",
+                        choices=["png", "hdf5"])
+    parser.add_argument("--full-usec", action="store_true")
+    parser.add_argument("--parquet", action="store_true")
+    parser.add_argument("--live", action="store_true")
+    parser.add_argument("--cache-segments", action="store_true")
+    parser.add_argument("--checkpoint-interval", type=float, default=300)
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument("--memory", action="store_true")
+    parser.add_argument("--metrics-port", type=int, default=None)
+    parser.add_argument("--metrics-file", default=None,
+                        help="File to write metrics to ('{pid}' is "
+                             "replaced with the process ID)")
+    parser.add_argument("--metrics-interval", type=float, default=10)
+    parser.add_argument("--queue-size", type=positive_int, default=21)
+    parser.add_argument("--adaptive-queue", action="store_true")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Segment queues in this many worker processes "
+                             "(0: segment in the main process)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Total threads for the run, divided between "
+                             "--jobs in batch mode and between --workers "
+                             "when segmenting in worker processes "
+                             "(default: one per core)")
+    parser.add_argument("--manifest", default=None)
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--headless", action="store_true")
+    parser.add_argument("--result-cache", nargs="?", const="default")
+    parser.add_argument("--result-cache-size", type=float, default=10,
+                        help="Maximum size of the result cache (in GB)")
+    parser.add_argument("--queue", default=None,
+                        help="Shared directory of a work queue. Processes "
+                             "queued jobs, unless --submit is also passed")
+    parser.add_argument("--submit", action="store_true")
+    parser.add_argument("--shard-frames", type=int, default=0)
+    parser.add_argument("--heartbeat-timeout", type=float, default=120)
+
+    return parser
+
+
+def positive_int(value):
+    """Argument type for counts which must be at least 1 (e.g. a queue
+    of 0 frames would never advance through the video)."""
+
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, not {}"
+                                         .format(value))
+
+    return value
+
+
+def apply_job_options(args, options):
+    """Return a copy of args with options (e.g. from a manifest) applied.
+    Option names match command-line flags, and string values (e.g.
+    from a CSV manifest) are converted in the same way as the flag's
+    command-line values. Other values are still checked by the flag's
+    type (e.g. a queue size of at least 1)."""
+
+    args = argparse.Namespace(**vars(args))
+    actions = {action.dest: action for action in build_parser()._actions}
+
+    for name, value in options.items():
+        name = name.strip().lstrip("-").replace("-", "_")
+        if name not in actions:
+            raise ValueError("Unknown option '{}'.".format(name))
+
+        action = actions[name]
+        if isinstance(value, str):
+            if action.nargs == 0:  # Flags such as --classify
+                value = value.strip().lower() in ["1", "true", "yes", "y"]
+            elif action.type is not None:
+                value = action.type(value)
+        elif action.type is not None and value is not None:
+            value = action.type(value)
+        setattr(args, name, value)
 
     return args
 
@@ -57,6 +149,10 @@ def select_filepaths():
 def gui_append_files(existing_file_list):
     """Select files using tk gui and append new files to passed list."""
 
+    # Only imported when needed, so headless runs never load tkinter
+    import tkinter as tk
+    from tkinter import filedialog
+
     # See: https://stackoverflow.com/questions/1406145/
     root = tk.Tk()
     root.withdraw()
@@ -194,6 +290,71 @@ def get_corners_from_file(filepath):
     return video_attributes["corners"]
 
 
+def load_manifest(filepath, args):
+    """Load a list of jobs from a manifest file, for headless batch runs.
+
+    A manifest is either a CSV/TSV file with one row per video, or a JSON
+    file containing a list of objects (or an object with a "jobs" list).
+    Each job must specify a video path ("filepath", or "Video name" as in
+    research/video_list.csv), relative to the manifest's directory if
+    not absolute. Jobs may also specify:
+
+        -"corners", as [[x1, y1], [x2, y2]] (otherwise read from the
+         video's attributes.json file)
+        -"start" and "end" frame numbers
+        -Any other command-line option (e.g. "classify", "batch_size"),
+         which overrides the option in args for that job only
+
+    Unrecognized columns (e.g. bookkeeping columns such as "Source" in
+    video_list.csv) are ignored with a warning."""
+
+    filepath = Path(filepath)
+
+    if filepath.suffix == ".json":
+        with open(str(filepath)) as json_file:
+            rows = json.load(json_file)
+        if isinstance(rows, dict):
+            rows = rows["jobs"]
+    else:
+        with open(str(filepath), newline="") as csv_file:
+            delimiter = "\t" if "\t" in csv_file.readline() else ","
+            csv_file.seek(0)
+            rows = list(csv.DictReader(csv_file, delimiter=delimiter))
+
+    jobs, ignored = [], set()
+    for row in rows:
+        # Empty CSV cells are treated as unspecified
+        options = {key: value for key, value in row.items()
+                   if value not in [None, ""]}
+
+        video = options.pop("filepath", options.pop("Video name", None))
+        if video is None:
+            raise ValueError("Manifest '{}' has a job without a filepath."
+                             .format(filepath.name))
+        video = filepath.parent / Path(video)
+
+        corners = options.pop("corners", None)
+        if isinstance(corners, str):
+            corners = json.loads(corners)
+        if corners is not None:
+            corners = [(int(corners[0][0]), int(corners[0][1])),
+                       (int(corners[1][0]), int(corners[1][1]))]
+
+        for name in list(options):
+            if not hasattr(args, name.lstrip("-").replace("-", "_")):
+                ignored.add(name)
+                del options[name]
+
+        jobs.append({"filepath": video.resolve(), "corners": corners,
+                     "options": options})
+
+    if ignored:
+        print("[!] Ignoring unrecognized manifest columns: {}."
+              .format(", ".join(sorted(ignored))))
+
+    return jobs
+
+
 def save_corners_to_file(filepath):
     """Serialize the corners associated with """
     base_dir = filepath.parent / filepath.stem
@@ -225,3 +386,17 @@ def frames_processed_status(frames_processed, total_frames):
     if frames_processed >= total_frames:
         sys.stdout.write("\n")
 
+
+def queue_size_status(queue_size, ms_per_frame):
+    sys.stdout.write("\n[-]     Queue size tuned to {} frames "
+                     "({:.1f} ms/frame).\n".format(queue_size, ms_per_frame))
+
+
+def provisional_count_status(minute, predicted, rejected):
+    sys.stdout.write("\r[-]     Provisional count after {0} min: {1} swifts "
+                     "({2} rejected).\n".format(minute, predicted, rejected))
+
+
+def reconciled_count_status(provisional, final):
+    sys.stdout.write("[-]     Final count: {0} swifts (provisional count "
+                     "was {1}).\n".format(final, provisional))
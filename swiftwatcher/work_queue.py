@@ -0,0 +1,273 @@
+"""
+    Contains functionality for distributing jobs across several worker
+    processes (possibly on different machines) which share a directory.
+    No external service is needed: jobs are claimed by atomically
+    renaming files between the following subdirectories of the queue:
+
+        pending/   Jobs waiting to be processed
+        claimed/   Jobs being processed. Each claimed file is named with
+                   a token unique to the claim, and workers periodically
+                   increment a heartbeat count within the jobs they hold,
+                   so that jobs held by dead workers can be re-queued.
+        done/      Jobs which were processed, including their results
+        failed/    Jobs which failed too many times
+        merged/    Markers for sharded videos whose results were merged
+"""
+
+from pathlib import Path
+import threading
+import socket
+import json
+import uuid
+import time
+import os
+
+QUEUE_DIRS = ["pending", "claimed", "done", "failed"]
+
+# Separates a job's ID from its claim token in claimed filenames
+CLAIM_SEPARATOR = "@"
+
+
+class WorkQueue:
+    """Shared-directory job queue. Each job is a JSON file describing a
+    video to process: {"filepath", "corners", "options"} (see
+    ui.load_manifest), where options may include a frame range."""
+
+    def __init__(self, queue_dir, heartbeat_timeout=120, max_attempts=3):
+        self.queue_dir = Path(queue_dir)
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+        self.worker_id = "{}-{}".format(socket.gethostname(), os.getpid())
+
+        # Heartbeat counts of claimed jobs, and when (by this worker's
+        # clock) each count was first seen. See requeue_stale().
+        self.observed = {}
+
+        # Other workers may be creating the same directories concurrently
+        for name in QUEUE_DIRS + ["merged"]:
+            Path.mkdir(self.queue_dir / name, parents=True, exist_ok=True)
+
+    def submit(self, jobs):
+        """Add jobs to the queue. Returns the IDs of the added jobs."""
+
+        job_ids = []
+        for job in jobs:
+            options = job["options"]
+            job_id = "{}_{}-{}_{}".format(Path(job["filepath"]).stem,
+                                          options.get("start", 0),
+                                          options.get("end", -1),
+                                          uuid.uuid4().hex[:8])
+            job = {"id": job_id, "filepath": str(job["filepath"]),
+                   "corners": job["corners"], "options": options,
+                   "output_subdir": job.get("output_subdir"),
+                   "shard": job.get("shard"),
+                   "attempts": 0, "submitted": time.time()}
+
+            # Written elsewhere first, so workers never read partial jobs
+            tmp_path = self.queue_dir / ".{}.tmp".format(job_id)
+            with open(str(tmp_path), "w") as json_file:
+                json.dump(job, json_file)
+            os.rename(str(tmp_path), str(self.job_path("pending", job_id)))
+            job_ids.append(job_id)
+
+        return job_ids
+
+    def claim(self):
+        """Claim the oldest pending job, returning it (or None if there
+        are no pending jobs). Renaming is atomic, so if several workers
+        try to claim the same job, exactly one succeeds."""
+
+        for path in sorted((self.queue_dir / "pending").glob("*.json")):
+            token = uuid.uuid4().hex[:8]
+            claimed_path = self.queue_dir / "claimed" / "{}{}{}.json".format(
+                path.stem, CLAIM_SEPARATOR, token)
+            try:
+                os.rename(str(path), str(claimed_path))
+            except OSError:
+                continue  # Claimed by another worker first
+
+            job = self.read_job(claimed_path)
+            job["attempts"] += 1
+            job["worker"] = self.worker_id
+            job["claim"] = token
+            job["heartbeats"] = 0
+            self.write_job(claimed_path, job)
+
+            if job["attempts"] > self.max_attempts:
+                self.finish(job, "failed", {"error": "Too many attempts."})
+                continue
+
+            return job
+
+        return None
+
+    def heartbeat(self, job):
+        """Mark a claimed job as still being processed, by incrementing
+        the heartbeat count stored in its claimed file."""
+
+        claimed_path = self.claimed_path(job)
+        if not claimed_path.exists():
+            return  # Job was re-queued after missed heartbeats
+
+        job["heartbeats"] += 1
+        self.write_job(claimed_path, job)
+
+    def finish(self, job, status, result):
+        """Move a claimed job to "done" or "failed", storing its result.
+        Returns False if this worker no longer holds the claim (i.e. the
+        job was re-queued, e.g. after a long pause), in which case the
+        job is left to whichever worker claims it next."""
+
+        claimed_path = self.claimed_path(job)
+        if not claimed_path.exists():
+            return False
+
+        job["result"] = result
+        job["finished"] = time.time()
+        self.write_job(claimed_path, job)
+
+        try:
+            os.rename(str(claimed_path), str(self.job_path(status,
+                                                           job["id"])))
+        except OSError:
+            return False  # Re-queued while the result was being written
+
+        return True
+
+    def requeue_stale(self):
+        """Return claimed jobs whose heartbeats have stopped (i.e. whose
+        worker has died) to the pending queue. A job is stale once its
+        heartbeat count hasn't changed for heartbeat_timeout seconds of
+        this worker's clock, so neither the clocks of other machines nor
+        the shared filesystem's modification times are relied upon."""
+
+        now = time.monotonic()
+        requeued, observed = [], {}
+        for path in (self.queue_dir / "claimed").glob("*.json"):
+            try:
+                heartbeats = self.read_job(path)["heartbeats"]
+            except (OSError, ValueError, KeyError):
+                continue  # Finished, re-queued, or being claimed
+
+            previous, first_seen = self.observed.get(path.name, (None, now))
+            if heartbeats != previous:
+                first_seen = now
+            observed[path.name] = (heartbeats, first_seen)
+
+            if now - first_seen > self.heartbeat_timeout:
+                job_id = path.stem.split(CLAIM_SEPARATOR)[0]
+                try:
+                    os.rename(str(path), str(self.job_path("pending",
+                                                           job_id)))
+                except OSError:
+                    continue  # Finished or re-queued by another worker
+                requeued.append(job_id)
+                del observed[path.name]
+
+        self.observed = observed
+
+        return requeued
+
+    def get_shard_jobs(self, group):
+        """Return the finished jobs for every shard of a video."""
+
+        jobs = []
+        for path in (self.queue_dir / "done").glob("*.json"):
+            try:
+                job = self.read_job(path)
+            except (OSError, ValueError):
+                continue
+            shard = job.get("shard")
+            if shard is not None and shard["group"] == group:
+                jobs.append(job)
+
+        return sorted(jobs, key=lambda job: job["shard"]["index"])
+
+    def claim_merge(self, group):
+        """Return True for exactly one worker which calls this for a
+        group of shards, so that their results are merged only once."""
+
+        try:
+            fd = os.open(str(self.queue_dir / "merged" / group),
+                         os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        os.close(fd)
+
+        return True
+
+    def counts(self):
+        return {name: len(list((self.queue_dir / name).glob("*.json")))
+                for name in QUEUE_DIRS}
+
+    def job_path(self, status, job_id):
+        return self.queue_dir / status / "{}.json".format(job_id)
+
+    def claimed_path(self, job):
+        return self.queue_dir / "claimed" / "{}{}{}.json".format(
+            job["id"], CLAIM_SEPARATOR, job["claim"])
+
+    def read_job(self, path):
+        with open(str(path)) as json_file:
+            return json.load(json_file)
+
+    def write_job(self, path, job):
+        tmp_path = path.with_suffix(".tmp")
+        with open(str(tmp_path), "w") as json_file:
+            json.dump(job, json_file)
+        os.replace(str(tmp_path), str(path))
+
+
+class Heartbeat:
+    """Background thread which heartbeats a claimed job until stopped.
+    Heartbeats are sent several times per timeout, so that a single
+    delayed heartbeat (e.g. a slow shared filesystem) doesn't cause a
+    job to be re-queued."""
+
+    def __init__(self, queue, job):
+        self.queue = queue
+        self.job = job
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.queue.heartbeat_timeout / 4):
+            self.queue.heartbeat(self.job)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def split_into_shards(job, end_frame, shard_frames, overlap=0, fps=None):
+    """Split a job into jobs covering consecutive ranges of at most
+    shard_frames frames, where end_frame is the (exclusive) end of the
+    job's range. Each shard's results are exported to its own
+    subdirectory, then merged once every shard is done.
+
+    Each shard also processes the overlap frames before its range, so
+    that events which cross a shard boundary are still tracked in full.
+    (Events are only counted by the shard whose range they end in.) An
+    event is only detected on the frame after its segment disappears,
+    so every shard but the last also processes the frame after its
+    range."""
+
+    start = int(job["options"].get("start", 0))
+    starts = list(range(start, end_frame, shard_frames))
+    group = "{}_{}".format(Path(job["filepath"]).stem, uuid.uuid4().hex[:8])
+
+    shards = []
+    for index, shard_start in enumerate(starts):
+        shard_end = min(shard_start + shard_frames, end_frame)
+        options = dict(job["options"], start=max(start, shard_start - overlap),
+                       end=min(shard_end + 1, end_frame))
+        shard = {"group": group, "index": index, "count": len(starts),
+                 "start": shard_start, "end": shard_end,
+                 "video_start": start, "video_end": end_frame, "fps": fps}
+        output_subdir = (Path("shards") / group /
+                         "{}-{}".format(shard_start, shard_end))
+        shards.append(dict(job, options=options, shard=shard,
+                           output_subdir=str(output_subdir)))
+
+    return shards
@@ -0,0 +1,53 @@
+"""
+    Tests for splitting jobs into shards of consecutive frames. (See
+    swiftwatcher.work_queue.split_into_shards.)
+"""
+
+import swiftwatcher.work_queue as wq
+
+JOB = {"filepath": "/videos/roost.mp4", "corners": None, "options": {}}
+
+
+def frames_read(shard):
+    """Frame numbers read by a shard's job (end is exclusive)."""
+
+    return range(shard["options"]["start"], shard["options"]["end"])
+
+
+def owners(shards, frame_number):
+    """Shards which count an event ending on frame_number."""
+
+    return [shard for shard in shards
+            if shard["shard"]["start"] <= frame_number
+            < shard["shard"]["end"]]
+
+
+def test_event_at_shard_boundary_is_counted_once():
+    shards = wq.split_into_shards(JOB, 300, 100, overlap=21)
+
+    # A segment last seen on frame 99 is only detected as an event
+    # while frame 100 (the first frame of the next shard) is tracked
+    last_seen = 99
+    detected_on = last_seen + 1
+    counted_by = owners(shards, last_seen)
+
+    assert [shard["shard"]["index"] for shard in counted_by] == [0]
+    assert detected_on in frames_read(counted_by[0])
+
+
+def test_event_after_shard_boundary_is_counted_by_next_shard():
+    shards = wq.split_into_shards(JOB, 300, 100, overlap=21)
+
+    counted_by = owners(shards, 100)
+
+    assert [shard["shard"]["index"] for shard in counted_by] == [1]
+    assert 100 - 21 in frames_read(counted_by[0])
+
+
+def test_shards_cover_job_range():
+    shards = wq.split_into_shards(dict(JOB, options={"start": 50}), 275, 100)
+
+    assert [(shard["shard"]["start"], shard["shard"]["end"])
+            for shard in shards] == [(50, 150), (150, 250), (250, 275)]
+    assert [shard["options"]["end"] for shard in shards] == [151, 251, 275]
+    assert len({shard["shard"]["group"] for shard in shards}) == 1